@@ -0,0 +1,535 @@
+from typing import Any, Callable, Dict, Iterable, List, Optional
+from contextlib import redirect_stdout
+from tempfile import TemporaryDirectory
+from types import SimpleNamespace
+from random import Random
+from time import perf_counter
+from pathlib import Path
+import argparse
+import asyncio
+import json
+import io
+
+from tomlkit import dumps, loads
+
+from klaimera import Event, EventManager, EventType, Klaimera
+import klaimera
+import klogging
+import kparse
+import kstats
+import kstore
+import kutils
+
+TEMPLATE = Path(__file__).parent.joinpath("config.toml-TEMPLATE")
+CORPUS = Path(__file__).parent.joinpath("corpus/mudae.jsonl")
+
+
+def corpus() -> List[Dict[str, Any]]:
+    with CORPUS.open() as file:
+        return [json.loads(line) for line in file]
+
+
+async def reacted(emoji: str) -> None:
+    pass
+
+
+def fake_embed(name: Optional[str], description: str, footer: Optional[str]) -> Any:
+    # Stands in for discord.Embed, with just what Klaimera reads off of one
+    return SimpleNamespace(
+        author=SimpleNamespace(name=name),
+        description=description,
+        footer=SimpleNamespace(text=footer),
+    )
+
+
+def fake_message(row: Dict[str, Any], channel: int = 0) -> Any:
+    # Stands in for a discord.Message from Mudae, made from a corpus row
+    if row["description"] is not None:
+        embeds = [fake_embed(row["name"], row["description"], row["footer"])]
+    else:
+        embeds = []
+
+    return SimpleNamespace(
+        content=row["content"],
+        embeds=embeds,
+        channel=SimpleNamespace(id=channel),
+        author=SimpleNamespace(id=klaimera.MUDAE_AID),
+        add_reaction=reacted,
+    )
+
+
+def template_config() -> kutils.Config:
+    config = kutils.Config()
+    config.toml = loads(TEMPLATE.read_text())
+    config.values = config.compile(config.toml)
+    config.reindex(set(kutils.Config.ids))
+    return config
+
+
+def names(rand: Random, count: int) -> List[str]:
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    return [
+        " ".join(
+            "".join(rand.choices(letters, k=rand.randint(3, 8))).title()
+            for _ in range(2)
+        )
+        for _ in range(count)
+    ]
+
+
+def legacy_parse(name, description, content, footer):
+    # Klaimera.parse() and roll_parse() as they were before kparse, for comparison
+    if (
+        isinstance(description, str)
+        and isinstance(name, str)
+        and not (isinstance(footer, str) and "Belongs to" in footer)
+        and any(
+            [
+                "React with any emoji to claim!" in description,
+                "Wished by" in content,
+                "<:kakera:469835869059153940>" in description.splitlines()[-1],
+            ]
+        )
+    ):
+        lines = description.splitlines()
+        kakera = 0
+
+        for line in lines:
+            if "<:kakera:469835869059153940>" in line:
+                for sub in line.split("**"):
+                    try:
+                        kakera = int(sub)
+
+                    except Exception:
+                        pass
+
+        return name, lines[0], kakera
+
+    return None
+
+
+async def empty():
+    pass
+
+
+def timed(func: Callable, runs: int) -> float:
+    # Microseconds per operation
+    stime = perf_counter()
+    func()
+    return (perf_counter() - stime) / runs * 1e6
+
+
+def bench_eventmanager(
+    sizes: Iterable[int] = (1_000, 10_000, 100_000)
+) -> Dict[str, float]:
+    results = {}
+    rand = Random(0)
+
+    for size in sizes:
+        eventmgr = EventManager()
+        events = [
+            Event(
+                type=rand.choice(list(EventType)),
+                timestamp=rand.randrange(size * 10),
+                call=empty,
+            )
+            for _ in range(size)
+        ]
+        handles: List[int] = []
+
+        results[f"eventmgr.push[{size}]"] = timed(
+            lambda: handles.extend(map(eventmgr.push, events)), size
+        )
+
+        victims = rand.sample(handles, size // 2)
+        results[f"eventmgr.cancel[{size}]"] = timed(
+            lambda: list(map(eventmgr.cancel, victims)), len(victims)
+        )
+
+        remaining = len(eventmgr)
+        results[f"eventmgr.pop[{size}]"] = timed(
+            lambda: [eventmgr.pop() for _ in range(remaining)], remaining
+        )
+
+    return results
+
+
+def bench_journal(sizes: Iterable[int] = (1_000, 10_000, 100_000)) -> Dict[str, float]:
+    results = {}
+
+    for size in sizes:
+        with TemporaryDirectory() as temp_dir:
+            journal = kutils.Journal(Path(temp_dir).joinpath("events.journal"))
+
+            # Every other dispatch is cancelled, as fired one-shot events would be
+            for handle in range(size):
+                journal.record(
+                    op="d", h=handle, t=500, at=0.0, c="roll", r=False, d=0.0, m=0
+                )
+
+                if handle % 2:
+                    journal.record(op="c", h=handle)
+
+            records = len(journal.pending)
+            asyncio.run(journal.flush())
+
+            results[f"journal.replay[{size}]"] = timed(
+                lambda: asyncio.run(journal.replay()), records
+            )
+
+    return results
+
+
+def bench_config(runs: int = 100_000) -> Dict[str, float]:
+    config = template_config()
+    ids = [kutils.Config.ids[index % len(kutils.Config.ids)] for index in range(runs)]
+
+    def legacy(id: str):
+        # Config.get() as it was before the flat cache, for comparison
+        joiner = "']['"
+        return eval(f"toml['{joiner.join(id.split('.'))}']", {"toml": config.toml})
+
+    return {
+        "config.get[legacy]": timed(lambda: list(map(legacy, ids)), runs),
+        "config.get": timed(lambda: list(map(config.get, ids)), runs),
+    }
+
+
+def bench_config_load(
+    sizes: Iterable[int] = (1_000, 10_000), runs: int = 3
+) -> Dict[str, float]:
+    results = {}
+    rand = Random(0)
+
+    async def load(path: Path, fresh: bool) -> float:
+        config = kutils.Config()
+        config.path = path
+        await config.load()
+        stime = perf_counter()
+
+        for _ in range(runs):
+            # Fresh, every key is validated and the targets indexed as on start up;
+            # otherwise nothing changed, as on a reload after an unrelated edit.
+            if fresh:
+                config = kutils.Config()
+                config.path = path
+
+            await config.load()
+
+        return (perf_counter() - stime) / runs * 1e6
+
+    for size in sizes:
+        toml = loads(TEMPLATE.read_text())
+        toml["target"]["roll"]["character"] = names(rand, size)  # type: ignore
+        toml["target"]["roll"]["series"] = names(rand, size)  # type: ignore
+
+        with TemporaryDirectory() as temp_dir:
+            path = Path(temp_dir).joinpath("config.toml")
+            path.write_text(dumps(toml))
+
+            results[f"config.load[{size}]"] = asyncio.run(load(path, True))
+            results[f"config.reload[{size}]"] = asyncio.run(load(path, False))
+
+    return results
+
+
+def bench_targets(size: int = 50_000, runs: int = 10_000) -> Dict[str, float]:
+    rand = Random(0)
+    targeted = names(rand, size)
+    queries = rand.choices(targeted, k=runs // 2) + targeted[: runs // 2][::-1]
+    misses = [name + "x" for name in rand.choices(targeted, k=runs)]
+
+    stime = perf_counter()
+    targets = kutils.TargetIndex(targeted, targeted)
+    targets.build()
+    build = (perf_counter() - stime) * 1e6
+
+    return {
+        f"targets.build[{size}]": build,
+        f"targets.character[legacy,{size}]": timed(
+            lambda: [query in targeted for query in queries], runs
+        ),
+        f"targets.character[{size}]": timed(
+            lambda: list(map(targets.character, queries)), runs
+        ),
+        f"targets.near[{size}]": timed(lambda: list(map(targets.near, misses)), runs),
+    }
+
+
+def bench_parser(runs: int = 100_000) -> Dict[str, float]:
+    messages = [
+        (row["name"], row["description"], row["content"], row["footer"])
+        for row in corpus()
+        if row["description"] is not None
+    ]
+
+    def parse(name, description, content, footer):
+        record = kparse.parse_roll(name, description, content, footer)
+
+        if record is not None and not record.claimed:
+            return record.name, record.series, record.kakera
+
+        return None
+
+    for message in messages:
+        assert parse(*message) == legacy_parse(*message), message
+
+    messages = [messages[index % len(messages)] for index in range(runs)]
+
+    return {
+        "parse[legacy]": timed(
+            lambda: [legacy_parse(*mesg) for mesg in messages], runs
+        ),
+        "parse": timed(lambda: [parse(*mesg) for mesg in messages], runs),
+    }
+
+
+def bench_classifier(runs: int = 100_000) -> Dict[str, float]:
+    classifier = kparse.Classifier([0])
+    messages = [(row["content"], row["description"], row["kind"]) for row in corpus()]
+
+    # Being a prefilter, the classifier may let through what the parsers discard
+    # but must never reject what they would accept.
+    for content, description, kind in messages:
+        if kind != "other":
+            assert classifier.classify(0, content, description).name.lower() == kind
+
+    messages = [messages[index % len(messages)] for index in range(runs)]
+
+    return {
+        "classify": timed(
+            lambda: [
+                classifier.classify(0, content, description)
+                for content, description, _ in messages
+            ],
+            runs,
+        ),
+    }
+
+
+def bench_store(size: int = 100_000, batch: int = 512) -> Dict[str, float]:
+    rand = Random(0)
+    series = [f"Series {index}" for index in range(size // 100)]
+    records = [
+        kparse.RollRecord(
+            f"Character {rand.randrange(size // 10)}",
+            rand.choice(series),
+            rand.randrange(30, 1000),
+            (),
+            False,
+            None,
+            True,
+        )
+        for _ in range(size)
+    ]
+    results = {}
+
+    async def run():
+        with TemporaryDirectory() as temp_dir:
+            store = kstore.RollStore(Path(temp_dir).joinpath("rolls.db"))
+            await store.open()
+            store.writer.cancel()  # type: ignore
+
+            stime = perf_counter()
+
+            for index, record in enumerate(records):
+                store.roll(record, at=float(index))
+
+                if index % 10 == 0:
+                    store.claim("user", record.name, at=float(index))
+
+                if len(store) >= batch:
+                    await store.flush()
+
+            await store.flush()
+            results[f"store.insert[{size}]"] = (perf_counter() - stime) / size * 1e6
+
+            for name, query in (
+                ("top_kakera", store.top_kakera()),
+                ("series_frequency", store.series_frequency()),
+                ("claim_rate", store.claim_rate(3 * 60 * 60, since=size * 0.9)),
+            ):
+                stime = perf_counter()
+                await query
+                results[f"store.{name}[{size}]"] = (perf_counter() - stime) * 1e6
+
+            await store.close()
+
+    asyncio.run(run())
+
+    return results
+
+
+def bench_dispatcher(
+    sizes: Iterable[int] = (1_000, 10_000, 100_000)
+) -> Dict[str, float]:
+    # Every event is due at once, so lateness is how long each waited on the drain
+    results = {}
+    klaimera.logger.log_level = 5
+
+    async def run(size: int):
+        eventmgr = EventManager()
+        fired = 0
+        done = asyncio.Event()
+
+        async def fire():
+            nonlocal fired
+            fired += 1
+
+            if fired == size:
+                done.set()
+
+        now = eventmgr.clock()
+
+        for _ in range(size):
+            eventmgr.push(Event(type=EventType.ROLL, timestamp=now, call=fire))
+
+        stime = perf_counter()
+        dispatcher = asyncio.get_running_loop().create_task(eventmgr.dispatcher())
+        await done.wait()
+        elapsed = perf_counter() - stime
+        dispatcher.cancel()
+
+        lateness = eventmgr.lateness[EventType.ROLL]
+        results[f"dispatcher[{size}]"] = elapsed / size * 1e6
+        results[f"dispatcher.late.mean[{size}]"] = lateness.mean * 1e6
+        results[f"dispatcher.late.max[{size}]"] = lateness.max * 1e6
+
+    for size in sizes:
+        asyncio.run(run(size))
+
+    return results
+
+
+class BenchKlaimera(Klaimera):
+    # Never connected, so the user is faked along with the messages
+    user = SimpleNamespace(id=1, name="somebody", display_name="somebody")
+
+
+def bench_klaimera(runs: int = 20_000) -> Dict[str, float]:
+    # Klaimera.parse() on fake messages, roll_parse() and claim_parse() included
+    rows = corpus()
+    messages = [fake_message(rows[index % len(rows)]) for index in range(runs)]
+    results = {}
+
+    async def run():
+        with TemporaryDirectory() as temp_dir:
+            kmra = BenchKlaimera.__new__(BenchKlaimera)
+            kmra.config = template_config()
+            kmra.config.values["target.roll.delay"] = [0.0, 0.0]
+            kmra.config.values["user.sound"] = False
+            kmra.config.values["user.notify"] = False
+            kmra.classifier = kparse.Classifier()
+            kmra.budget = kutils.TokenBucket(0)
+            kmra.stats = kstats.Stats(Path(temp_dir).joinpath("stats.json"))
+            kmra.store = kstore.RollStore(Path(temp_dir).joinpath("rolls.db"))
+            kmra.configure()
+            kmra.classifier.channels = frozenset([0])
+            klaimera.logger.log_level = 5
+            await kmra.store.open()
+
+            stime = perf_counter()
+
+            for message in messages:
+                await kmra.parse(message)
+
+            results["klaimera.parse"] = (perf_counter() - stime) / runs * 1e6
+            await kmra.store.close()
+
+    asyncio.run(run())
+
+    return results
+
+
+def bench_logger(runs: int = 100_000) -> Dict[str, float]:
+    # Logger.log() through to the write, in batches as the writer task would
+    results = {}
+
+    async def run(structured: bool):
+        with TemporaryDirectory() as temp_dir:
+            logger = klogging.Logger()
+            logger.log_dir = Path(temp_dir)
+            logger.log_file_path = logger.log_dir.joinpath("bench.log")
+            logger.structured = structured
+            logger.history.resize(100)
+
+            stime = perf_counter()
+
+            with redirect_stdout(io.StringIO()):
+                for index in range(runs):
+                    await logger.waifu(
+                        "Rolled {character} <{series}> [{kakera}]",
+                        event="ROLL",
+                        character="Yuki Nagato",
+                        series="Suzumiya Haruhi no Yuuutsu",
+                        kakera=index,
+                    )
+
+                    if index % logger.batch_max == 0:
+                        await logger.flush()
+
+                await logger.close()
+
+            name = "logger.log[json]" if structured else "logger.log"
+            results[name] = (perf_counter() - stime) / runs * 1e6
+
+    asyncio.run(run(False))
+    asyncio.run(run(True))
+
+    return results
+
+
+def compare(results: Dict[str, float], baseline: Dict[str, float], tolerance: float):
+    # Returns 1 should any result be slower than its baseline beyond the tolerance
+    regressed = 0
+
+    for name, value in results.items():
+        if (base := baseline.get(name)) is None:
+            print(f"{name:<40} {value:>12.3f} us   (new)")
+            continue
+
+        ratio = value / base if base else 1.0
+        flag = "REGRESSED" if ratio > 1 + tolerance else ""
+        regressed |= bool(flag)
+        print(f"{name:<40} {value:>12.3f} us {ratio:>7.2f}x {flag}")
+
+    return int(regressed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Klaimera's hot paths.")
+    parser.add_argument("--save", type=Path, help="Write the results as a baseline")
+    parser.add_argument("--compare", type=Path, help="Compare against a baseline")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Slowdown over the baseline flagged as a regression, 0.2 being 20%%",
+    )
+    args = parser.parse_args()
+
+    results: Dict[str, float] = {}
+    results.update(bench_eventmanager())
+    results.update(bench_dispatcher())
+    results.update(bench_journal())
+    results.update(bench_config())
+    results.update(bench_config_load())
+    results.update(bench_targets())
+    results.update(bench_parser())
+    results.update(bench_classifier())
+    results.update(bench_klaimera())
+    results.update(bench_logger())
+    results.update(bench_store())
+
+    if args.save:
+        args.save.write_text(json.dumps(results, indent=4) + "\n")
+
+    if args.compare:
+        exit(compare(results, json.loads(args.compare.read_text()), args.tolerance))
+
+    for name, value in results.items():
+        print(f"{name:<40} {value:>12.3f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+from typing import List, Optional
+from math import floor
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+
+
+class ResetCalendar:
+    # Mudae resets on a fixed lattice of absolute times: rolls every hour at the
+    # reset minute, claims every `claim` minutes on a subset of those. The reset
+    # minute and anchor hour are both taken in UTC, so the lattice is the same
+    # whatever the local time zone, season or DST changes in between, and all of it
+    # is kept in epoch seconds.
+    #
+    # Rolls can always be derived. Claims can be from the anchor when the claim
+    # period divides half a day, as then every day has a reset at the anchor hour;
+    # otherwise the phase is unknown until observed, e.g. from '$tu'.
+
+    def __init__(self, claim: int, reset: int, anchor: int) -> None:
+        self.period = claim * 60
+        self.roll_phase = reset * 60
+
+        if (DAY // 2) % self.period == 0:
+            self.claim_phase: Optional[float] = (
+                anchor * HOUR + self.roll_phase
+            ) % self.period
+        else:
+            self.claim_phase = None
+
+    @property
+    def derivable(self) -> bool:
+        return self.claim_phase is not None
+
+    @staticmethod
+    def after(phase: float, period: float, now: float, count: int) -> List[float]:
+        # The `count` lattice points strictly after `now`
+        first = phase + (floor((now - phase) / period) + 1) * period
+        return [first + index * period for index in range(count)]
+
+    def rolls(self, now: float, count: int = 1) -> List[float]:
+        return self.after(self.roll_phase, HOUR, now, count)
+
+    def claims(self, now: float, count: int = 1) -> List[float]:
+        if self.claim_phase is None:
+            return []
+
+        return self.after(self.claim_phase, self.period, now, count)
+
+    def observe(self, claim_at: float) -> None:
+        # Fixes the claim phase from an observed reset time. That is only known to
+        # the minute, so with claims on the hour it is snapped onto the nearest roll
+        # reset, and otherwise onto the minute.
+        if self.period % HOUR == 0:
+            step, phase = HOUR, self.roll_phase
+        else:
+            step, phase = 60, 0
+
+        self.claim_phase = (phase + round((claim_at - phase) / step) * step) % (
+            self.period
+        )
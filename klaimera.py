@@ -1,158 +1,425 @@
-from typing import Callable, NamedTuple, List, Union, Optional
+from time import monotonic, perf_counter, time
+
+STARTED = monotonic()  # Taken ahead of every other import, so as to time them
+
+from typing import Any, Callable, Dict, NamedTuple, List, Tuple, Union, Optional
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from statistics import median
+from heapq import heapify, heappop, heappush
+from pathlib import Path
+from itertools import count
 from random import uniform
-from bisect import insort
 from enum import Enum
-from time import time
-
-from asyncio import run, sleep, get_event_loop
-from uvloop import install
-import asteval  # type: ignore
+import argparse
+import re
+
+from asyncio import (
+    Event as AsyncEvent,
+    TimeoutError,
+    run,
+    sleep,
+    get_event_loop,
+    wait_for,
+)
 import discord
 
+import kcalendar
 import klogging
+import kparse
+import kstats
+import kstore
 import kutils
 
 MUDAE_AID = 432610292342587392
-aeval = asteval.Interpreter()
+COMMAND_PREFIX = "kmra "
+DISCORD_MESSAGE_MAX = 2000
+IMPORTED = monotonic()
+
+try:
+    # Unlike CLOCK_MONOTONIC, keeps counting while the system is suspended
+    from time import CLOCK_BOOTTIME, clock_gettime
+
+    def boottime() -> float:
+        return clock_gettime(CLOCK_BOOTTIME)
+
+except ImportError:
+    boottime = monotonic
+
 logger = klogging.Logger()
 
 
 class EventType(Enum):
-    CONFIG_RELOAD = 100
     RESET_CLAIM = 200
     RESET_KAKERA = 201
     RESET_DAILY = 202
     RESET_VOTE = 203
+    RESET_ROLL = 204
     SYNC_TIME = 300
-    EVENTMGR_BENCH = 400
     ROLL = 500
 
 
+class Missed(Enum):
+    # What a recurring event does when the dispatcher gets to it a whole period or
+    # more past its deadline, e.g. after a suspend or a long stall.
+    COALESCE = 0  # Fire once, then resume on the next slot
+    CATCHUP = 1  # Fire once for every slot that was missed
+    SKIP = 2  # Do not fire, resume on the next slot
+
+
 class Event(NamedTuple):
     type: EventType
-    timestamp: int
+    timestamp: float  # On EventManager.clock
     call: Callable
     recur: bool = False
     delta: timedelta = timedelta()
+    missed: Missed = Missed.COALESCE
 
     def __lt__(self, other_event):
         return self.timestamp < other_event.timestamp
 
 
+class Command(NamedTuple):
+    handler: str  # Name of the Klaimera method taking (args, message)
+    args: "re.Pattern[str]"  # Whole argument string, "" when none are given
+
+
+class Lateness:
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.count} dispatched, late by {self.last:.3f}s last, "
+            f"{self.mean:.3f}s mean, {self.max:.3f}s max"
+        )
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def record(self, late: float) -> None:
+        self.count += 1
+        self.total += late
+        self.last = late
+        self.max = max(self.max, late)
+
+
 class EventManager:
+    # Events are kept in a binary heap of [timestamp, handle, event] entries. Cancelled
+    # entries are blanked in place (lazy deletion) and skipped when they surface, so
+    # pushing, popping and cancelling are all O(log n) at worst.
+    #
+    # Timestamps are on the boot time clock, where there is one, so that wall clock
+    # steps (NTP, manual changes) neither fire nor delay anything, while time spent
+    # suspended still counts and shows as lateness; dispatch() converts from wall
+    # time. The loop's own timers stop during a suspend, so the dispatcher never
+    # waits longer than wait_max at once, to notice what came due in one.
+    clock = staticmethod(boottime)
+    wait_max = 60.0
+
     def __init__(self) -> None:
-        self.events: List[Event] = []
-        self.overhead: Union[float, int] = 0
+        self.queue: List[list] = []
+        self.entries: Dict[int, list] = {}
+        self.index: Dict[EventType, Dict[int, Event]] = {}
+        self.lateness: Dict[EventType, Lateness] = {}
+        self.calls: Dict[str, Callable] = {}
+        self.names: Dict[Callable, str] = {}
+        self.journal: Optional[kutils.Journal] = None
+        self.journaled: Dict[int, Dict[str, Any]] = {}
+        self.handles = count()
+        self.cancelled = 0
+        self.wakeup = AsyncEvent()
+
+    def __len__(self) -> int:
+        return len(self.entries)
 
-    async def dispatcher(self, interval: int = 1, bench: bool = False) -> None:
-        while True:
-            ctime = int(time())
+    @property
+    def events(self) -> List[Tuple[int, Event]]:
+        return [(handle, event) for _, handle, event in sorted(self.entries.values())]
 
-            if len(self.events) > 0 and (
-                ctime == self.events[0].timestamp or ctime > self.events[0].timestamp
-            ):
-                event: Event = self.events.pop(0)
-
-                if bench is False:
-                    if event.recur:
-                        next_timestamp = int(
-                            (
-                                datetime.fromtimestamp(event.timestamp) + event.delta
-                            ).timestamp()
-                        )
-
-                        insort(
-                            self.events,
-                            Event(
-                                type=event.type,
-                                timestamp=next_timestamp,
-                                call=event.call,
-                                recur=event.recur,
-                                delta=event.delta,
-                            ),
-                        )
-
-                        add_info = (
-                            f"dispatch, recurs every {event.delta} with next call "
-                            f"scheduled for {next_timestamp}."
-                        )
-
-                    else:
-                        add_info = "dispatch."
-
-                    await logger.info(f"Callling scheduled {add_info}")
+    def of_type(self, type: EventType) -> Dict[int, Event]:
+        return self.index.get(type, {})
 
-                loop = get_event_loop()
-                loop.create_task(event.call())
+    def push(self, event: Event) -> int:
+        handle = next(self.handles)
+        entry = [event.timestamp, handle, event]
+
+        heappush(self.queue, entry)
+        self.entries[handle] = entry
+        self.index.setdefault(event.type, {})[handle] = event
+
+        if self.queue[0] is entry:
+            self.wakeup.set()
 
-            if bench:
-                break
+        if self.journal and (name := self.names.get(event.call)) is not None:
+            self.journaled[handle] = record = {
+                "op": "d",
+                "h": handle,
+                "t": event.type.value,
+                "at": time() + (event.timestamp - self.clock()),
+                "c": name,
+                "r": event.recur,
+                "d": event.delta.total_seconds(),
+                "m": event.missed.value,
+            }
+            self.journal.record(**record)
 
-            await sleep(interval - self.overhead)
+        return handle
 
-    async def benchmark(self):
-        async def empty():
-            pass
+    def peek(self) -> Optional[Event]:
+        while self.queue and self.queue[0][2] is None:
+            heappop(self.queue)
+            self.cancelled -= 1
 
-        times = []
+        return self.queue[0][2] if self.queue else None
 
-        for _ in range(10):
-            self.events.insert(
-                0,
+    def pop(self) -> Optional[Event]:
+        if (event := self.peek()) is None:
+            return None
+
+        _, handle, _ = heappop(self.queue)
+        self._forget(handle, event)
+
+        return event
+
+    def cancel(self, handle: int) -> bool:
+        if (entry := self.entries.get(handle)) is None:
+            return False
+
+        self._forget(handle, entry[2])
+        entry[2] = None
+        self.cancelled += 1
+
+        # Rebuild once the heap is mostly dead weight, keeping memory bounded when
+        # many events are cancelled before they ever reach the head.
+        if self.cancelled > 64 and self.cancelled > len(self.entries):
+            self.queue = [entry for entry in self.queue if entry[2] is not None]
+            heapify(self.queue)
+            self.cancelled = 0
+
+        return True
+
+    def cancel_type(self, type: EventType) -> int:
+        handles = list(self.of_type(type))
+
+        for handle in handles:
+            self.cancel(handle)
+
+        return len(handles)
+
+    def _forget(self, handle: int, event: Event) -> None:
+        del self.entries[handle]
+
+        if self.journaled.pop(handle, None) is not None:
+            self.journal.record(op="c", h=handle)  # type: ignore
+
+        del (typed := self.index[event.type])[handle]
+
+        if not typed:
+            del self.index[event.type]
+
+    def register(self, name: str, call: Callable) -> None:
+        # Only events whose call is registered are journaled, as the name is what
+        # gets persisted and resolved again on restore.
+        self.calls[name] = call
+        self.names[call] = name
+
+    async def restore(self, journal: kutils.Journal) -> None:
+        stime = monotonic()
+        live = await journal.replay()
+        records = journal.records
+
+        self.journal = journal
+
+        for record in live.values():
+            if (call := self.calls.get(record["c"])) is None:
+                continue
+
+            self.push(
                 Event(
-                    type=EventType.EVENTMGR_BENCH,
-                    timestamp=int(time()),
-                    call=empty,
-                    recur=False,
-                ),
+                    type=EventType(record["t"]),
+                    timestamp=self.clock() + (record["at"] - time()),
+                    call=call,
+                    recur=record["r"],
+                    delta=timedelta(seconds=record["d"]),
+                    missed=Missed(record["m"]),
+                )
             )
 
-            stime = time()
-            await self.dispatcher(bench=True)
-            times.append(time() - stime)
+        # Handles are reissued on restore, so start the journal afresh from them
+        await journal.compact(self.journaled.values())
+
+        elapsed = monotonic() - stime
+        await logger.info(
+            "Restored {restored} event(s) from {records} journal record(s) in "
+            "{elapsed:.3f}s ({rate:.0f}/s)",
+            restored=len(self.journaled),
+            records=records,
+            elapsed=elapsed,
+            rate=records / max(elapsed, 1e-9),
+        )
+
+    async def sync(self) -> None:
+        if not self.journal:
+            return
+
+        if self.journal.records + len(self.journal.pending) > 256 + 2 * len(
+            self.journaled
+        ):
+            await self.journal.compact(self.journaled.values())
+        else:
+            await self.journal.flush()
+
+    def wall(self, timestamp: float) -> datetime:
+        return datetime.now() + timedelta(seconds=timestamp - self.clock())
+
+    def reschedule(self, event: Event, now: float) -> Tuple[bool, Optional[Event]]:
+        # Returns whether the event fires now, and its next occurrence. Slots are
+        # always whole periods from the original deadline so recurrences never drift.
+        if not event.recur:
+            return True, None
+
+        period = event.delta.total_seconds()
+        missed = int((now - event.timestamp) // period) if period > 0 else 0
+
+        if event.missed is Missed.CATCHUP or missed < 1:
+            fire, slots = True, 1
+        else:
+            fire, slots = event.missed is Missed.COALESCE, missed + 1
+
+        return fire, event._replace(timestamp=event.timestamp + slots * period)
+
+    async def dispatcher(self) -> None:
+        while True:
+            # Drain everything that is due in one pass, then sleep until the next
+            # deadline or until push() schedules something earlier.
+            while (head := self.peek()) is not None and head.timestamp <= (
+                now := self.clock()
+            ):
+                event: Event = self.pop()  # type: ignore
+                fire, next_event = self.reschedule(event, now)
+
+                if event.type not in self.lateness:
+                    self.lateness[event.type] = Lateness()
+
+                self.lateness[event.type].record(now - event.timestamp)
+
+                if next_event is not None:
+                    self.push(next_event)
+
+                if not fire:
+                    await logger.warn(
+                        "Skipped scheduled {event}, late by {late:.3f}s",
+                        event=event.type.name,
+                        late=now - event.timestamp,
+                    )
+                    continue
+
+                if next_event is not None:
+                    await logger.info(
+                        "Calling scheduled {event} dispatch, recurs every {every}s "
+                        "with next call in {next_in:.3f}s.",
+                        event=event.type.name,
+                        every=event.delta.total_seconds(),
+                        next_in=next_event.timestamp - now,
+                    )
+
+                else:
+                    await logger.info(
+                        "Calling scheduled {event} dispatch.", event=event.type.name
+                    )
+
+                loop = get_event_loop()
+                loop.create_task(event.call())
+
+            await self.sync()
+            self.wakeup.clear()
+
+            if (head := self.peek()) is not None:
+                timeout: Optional[float] = min(
+                    max(head.timestamp - self.clock(), 0), self.wait_max
+                )
+            else:
+                timeout = None
+
+            try:
+                await wait_for(self.wakeup.wait(), timeout)
 
-        self.overhead = median(times)
+            except TimeoutError:
+                pass
 
     async def dispatch(
         self,
         type: EventType,
         call: Callable,
-        at: Union[timedelta, int, datetime],
+        at: Union[timedelta, float, datetime],
         recur: bool = False,
         delta: timedelta = timedelta(),
-    ) -> None:
+        missed: Missed = Missed.COALESCE,
+    ) -> int:
+        # `at` is a delay, a datetime or a UNIX timestamp; the latter two are taken
+        # against the wall clock once here and are monotonic from then on.
+        if recur and delta <= timedelta():
+            # It would be pushed back at the same time forever, never yielding
+            raise ValueError(f"Recurring {type.name} needs a positive delta")
+
         if isinstance(at, timedelta):
             time_info = datetime.now() + at
-            timestamp = int(time_info.timestamp())
+            timestamp = self.clock() + at.total_seconds()
         elif isinstance(at, datetime):
-            timestamp = int(at.timestamp())
             time_info = at
+            timestamp = self.clock() + (at.timestamp() - time())
         else:
-            timestamp = at
             time_info = datetime.fromtimestamp(at)
+            timestamp = self.clock() + (at - time())
 
-        if recur:
-            recur_info = f", recurring every {delta}."
-        else:
-            recur_info = "."
-
-        await logger.info(f"Dispatched {type} for {time_info}{recur_info}")
+        await logger.info(
+            "Dispatched {event} for {at}{recur}",
+            event=type.name,
+            at=time_info,
+            recur=f", recurring every {delta}." if recur else ".",
+        )
 
-        insort(
-            self.events,
+        handle = self.push(
             Event(
                 type=type,
                 timestamp=timestamp,
                 call=call,
                 recur=recur,
                 delta=delta,
+                missed=missed,
             ),
         )
 
+        await self.sync()
+
+        return handle
+
 
 class Klaimera(discord.Client):
+    # Looked up by the first word after the prefix. Arguments not matching the
+    # command's pattern are rejected as invalid before its handler is called, and
+    # commands.<name> disables a command, as commands.enable does all of them.
+    commands = {
+        "config": Command("command_config", re.compile(r".*", re.DOTALL)),
+        "dispatch": Command("command_dispatch", re.compile(r"(?:\S+ cancel)?")),
+        "notify": Command(
+            "command_notify", re.compile(r"alert|push(?: .+)?", re.DOTALL)
+        ),
+        "status": Command("command_status", re.compile(r"")),
+        "logs": Command("command_logs", re.compile(r"(?:\S+(?: \S+)?)?")),
+    }
+
+    # 429s in a row after which roll() gives up on the rest of the roll window
+    rate_limits_max = 3
+
+    # Bounds on what 'kmra logs' sends, in records and in messages
+    logs_max = 100
+    logs_pages_max = 3
+
     async def command_config(
         self, args: Optional[str], message: discord.Message
     ) -> int:
@@ -164,12 +431,28 @@ class Klaimera(discord.Client):
         if args and len(sargs := args.split(" ", 1)) > 1:
             base, sub = sargs
 
-            if base.isnumeric() and (index := int(base)) <= len(self.eventmgr.events):
-                ...
+            if sub != "cancel":
+                return 1
+
+            elif base.isnumeric() and (index := int(base)) < len(self.eventmgr):
+                handle, event = self.eventmgr.events[index]
+                self.eventmgr.cancel(handle)
+                await self.eventmgr.sync()
+                await logger.info(
+                    "Cancelled {event} at index {index}",
+                    event=event.type.name,
+                    index=index,
+                )
                 return 0
 
-            elif base.upper() in [event.name for event in EventType]:
-                ...
+            elif base.upper() in EventType.__members__:
+                cancelled = self.eventmgr.cancel_type(EventType[base.upper()])
+                await self.eventmgr.sync()
+                await logger.info(
+                    "Cancelled {cancelled} {event} event(s)",
+                    cancelled=cancelled,
+                    event=base.upper(),
+                )
                 return 0
 
             else:
@@ -178,13 +461,16 @@ class Klaimera(discord.Client):
         elif not args:
             event_list = ""
 
-            for evindex, event in enumerate(self.eventmgr.events):
+            for evindex, (_, event) in enumerate(self.eventmgr.events):
                 if event.recur:
-                    detail_recur = f"is recurring every {event.delta}"
+                    detail_recur = (
+                        f"is recurring every {event.delta}, "
+                        f"{event.missed.name.lower()} on missed runs"
+                    )
                 else:
                     detail_recur = "is non-recurring"
 
-                event_at = datetime.fromtimestamp(event.timestamp)
+                event_at = self.eventmgr.wall(event.timestamp)
                 event_in = event_at - datetime.now()
 
                 event_list += (
@@ -193,6 +479,9 @@ class Klaimera(discord.Client):
                     f" {detail_recur}\n"
                 )
 
+            for type, lateness in self.eventmgr.lateness.items():
+                event_list += f"\n[{type.name}] {lateness}"
+
             await message.reply(f"```{event_list}```")
 
             return -1
@@ -203,7 +492,30 @@ class Klaimera(discord.Client):
     async def command_status(
         self, args: Optional[str], message: discord.Message
     ) -> int:
-        return 2
+        if args:
+            return 1
+
+        status = (
+            f"{self.stats.render()}\nrolls: {self.budget}\n"
+            f"notify: {kutils.notifier}\nalert: {kutils.alerter}\n\n"
+            f"{self.classifier}\n"
+        )
+
+        for type, lateness in self.eventmgr.lateness.items():
+            status += f"\n[{type.name}] {lateness}"
+
+        for name, executor in kutils.executors.items():
+            status += f"\n[{name}] {executor}"
+
+        for name, latency in self.command_latency.items():
+            status += (
+                f"\n[kmra {name}] {latency.count} run, {latency.quantile(0.5):.1f}ms "
+                f"p50, {latency.quantile(0.99):.1f}ms p99"
+            )
+
+        await message.reply(f"```{status}```")
+
+        return -1
 
     async def command_notify(
         self, args: Optional[str], message: discord.Message
@@ -226,6 +538,39 @@ class Klaimera(discord.Client):
         else:
             return 1
 
+    async def command_logs(self, args: Optional[str], message: discord.Message) -> int:
+        levels = {name: level for level, name in logger.level_map.items()}
+        level, count = 0, 10
+
+        for arg in args.split() if args else []:
+            if arg.upper() in levels:
+                level = levels[arg.upper()]
+            elif arg.isnumeric():
+                count = min(int(arg), self.logs_max)
+            else:
+                return 1
+
+        # Paginated to stay under Discord's message length limit, code block included
+        page_max = DISCORD_MESSAGE_MAX - len("``````")
+        pages = [""]
+
+        for record in logger.history.last(count, level):
+            record = record[: page_max - 1]
+
+            if len(pages[-1]) + len(record) + 1 > page_max:
+                pages.append("")
+
+            pages[-1] += record + "\n"
+
+        # Past the limit the oldest pages are left out, keeping the newest records
+        pages = pages[-self.logs_pages_max :]
+        await message.reply(f"```{pages[0] or 'No logs.'}```")
+
+        for page in pages[1:]:
+            await message.channel.send(f"```{page}```")
+
+        return -1
+
     async def command_exec(self, message: discord.Message) -> int:
         # Return Codes:
         # -1 : OK, Do not react with emojiSuccess
@@ -233,198 +578,499 @@ class Klaimera(discord.Client):
         #  1 : Invalid
         #  2 : Error
 
-        if len(scmd := message.content.lstrip("kmra ").split(" ", 1)) == 1:
-            base, args = scmd[0], None
-        else:
-            base, args = scmd
+        base, _, args = message.content[len(COMMAND_PREFIX) :].partition(" ")
+
+        if (
+            base not in self.enabled
+            or (command := self.commands[base]).args.fullmatch(args) is None
+        ):
+            return 1
+
+        stime = perf_counter()
 
-        if base == "config":
-            return await self.command_config(args, message)
+        try:
+            return await getattr(self, command.handler)(args or None, message)
 
-        elif base == "dispatch":
-            return await self.command_dispatch(args, message)
+        finally:
+            if base not in self.command_latency:
+                self.command_latency[base] = kstats.QuantileSketch()
 
-        elif base == "notify":
-            return await self.command_notify(args, message)
+            self.command_latency[base].add((perf_counter() - stime) * 1000)
 
-        elif base == "status":
-            return await self.command_status(args, message)
+    async def event_reloader(self):
+        try:
+            await self.config.load()
+
+        except Exception as exc:
+            await logger.warn("Unsuccessful config reload", exc=exc)
 
         else:
-            return 1
+            self.configure()
+            await kutils.alerter.load()
+            await self.schedule_resets()
+            await logger.info("Reloaded config")
+
+    def configure(self):
+        # Applies the freshly (re)loaded config to everything derived from it
+        self.classifier.channels = frozenset(self.config.get("server.channel"))
+        logger.log_level = self.config.get("user.log_level")
+        logger.structured = self.config.get("user.log_json")
+        logger.history.resize(self.config.get("user.log_max"))
+        kutils.alerter.enabled = self.config.get("user.sound")
+        kutils.notifier.enabled = self.config.get("user.notify")
+
+        self.calendar = kcalendar.ResetCalendar(
+            self.config.get("server.settings.claim"),
+            self.config.get("server.settings.claimReset"),
+            self.config.get("server.settings.claimAnchor"),
+        )
+        self.stats.period = self.calendar.period
+        self.budget.capacity = self.config.get("server.settings.rolls")
 
-    async def event_reloader(self):
-        if self.config.file_mtime != self.config.last_modified():
+        if self.config.get("commands.enable"):
+            self.enabled = frozenset(
+                name for name in self.commands if self.config.get(f"commands.{name}")
+            )
+        else:
+            self.enabled = frozenset()
+        self.stats.offset = self.calendar.claim_phase or 0
+
+    def restored(self, type: EventType, period: float, phase: Optional[float]) -> bool:
+        # Whether there is a single `type` event recurring every `period`, and on the
+        # lattice of `phase` if one is given, as only one brought back from the event
+        # journal would be at this point.
+        events = list(self.eventmgr.of_type(type).values())
+
+        if len(events) != 1 or events[0].delta.total_seconds() != period:
+            return False
+
+        if phase is None:
+            return True
+
+        at = self.eventmgr.wall(events[0].timestamp).timestamp()
+        offset = (at - phase) % period
+        return min(offset, period - offset) < 1
+
+    async def schedule_resets(self, restored: bool = False):
+        # Resets are registered as recurring events from the calendar. Should claim
+        # resets not be derivable, '$tu' is sent every other hour until they are.
+        #
+        # With `restored`, resets brought back from the event journal are kept as
+        # long as they are still on the calendar, so the schedule resumes where it
+        # left off, along with the claim phase observed from '$tu' before.
+        if not (
+            restored
+            and self.restored(
+                EventType.RESET_ROLL, kcalendar.HOUR, self.calendar.roll_phase
+            )
+        ):
+            self.eventmgr.cancel_type(EventType.RESET_ROLL)
+            await self.eventmgr.dispatch(
+                EventType.RESET_ROLL,
+                self.reset_roll,
+                at=self.calendar.rolls(time())[0],
+                recur=True,
+                delta=timedelta(hours=1),
+                missed=Missed.SKIP,
+            )
+
+        if restored and self.restored(
+            EventType.RESET_CLAIM, self.calendar.period, self.calendar.claim_phase
+        ):
+            if not self.calendar.derivable:
+                (claim,) = self.eventmgr.of_type(EventType.RESET_CLAIM).values()
+                self.calendar.observe(self.eventmgr.wall(claim.timestamp).timestamp())
+                self.stats.offset = self.calendar.claim_phase  # type: ignore
+
+        elif not (
+            restored
+            and not self.calendar.derivable
+            and self.restored(EventType.SYNC_TIME, 2 * kcalendar.HOUR, None)
+        ):
+            await self.schedule_claims()
+
+    async def schedule_claims(self):
+        self.eventmgr.cancel_type(EventType.RESET_CLAIM)
+        self.eventmgr.cancel_type(EventType.SYNC_TIME)
+
+        if self.calendar.derivable:
+            await self.eventmgr.dispatch(
+                EventType.RESET_CLAIM,
+                self.reset_claim,
+                at=self.calendar.claims(time())[0],
+                recur=True,
+                delta=timedelta(seconds=self.calendar.period),
+                missed=Missed.SKIP,
+            )
+
+        else:
+            await self.eventmgr.dispatch(
+                EventType.SYNC_TIME,
+                self.sync_time,
+                at=timedelta(),
+                recur=True,
+                delta=timedelta(hours=2),
+            )
+
+    async def reset_roll(self):
+        self.budget.refill(self.config.get("server.settings.rolls"))
+        await logger.info("Rolls reset")
+
+        if self.config.get("dispatch.roll.auto"):
+            await self.eventmgr.dispatch(EventType.ROLL, self.roll, at=timedelta())
+
+    async def roll(self):
+        # Sends rolls until the budget for this roll window is spent, a rate limit
+        # giving back the token for the roll it held up. Rolling stops for the window
+        # after rate_limits_max of them in a row, or right away on a Cloudflare one.
+        if self.rolling:
+            return
+
+        self.rolling = True
+        limited = 0
+
+        try:
+            await self.wait_until_ready()
+            channel = self.get_channel(self.config.get("server.channel")[0])
+
+            while self.config.get("dispatch.roll.auto") and self.budget.take():
+                wait_min, wait_max = self.config.get("dispatch.roll.delay")
+                await sleep(uniform(wait_min, wait_max))
+
+                try:
+                    await channel.send(self.config.get("dispatch.roll.command"))
+
+                except discord.HTTPException as exc:
+                    # Raised once the library's own retries on a 429 ran out, or for
+                    # one without a Via header (Cloudflare), which it never retries
+                    if exc.status != 429:
+                        raise
+
+                    retry_after = self.retry_after(exc)
+                    cloudflare = "Via" not in exc.response.headers
+
+                else:
+                    limited = 0
+                    continue
+
+                limited += 1
+                self.budget.refund()
+
+                if cloudflare or limited >= self.rate_limits_max:
+                    self.budget.drain()
+                    await logger.error(
+                        "Rate limited rolling {limited} time(s) in a row"
+                        "{cloudflare}, stopping until the next roll reset",
+                        limited=limited,
+                        cloudflare=" by Cloudflare" if cloudflare else "",
+                    )
+                    break
+
+                await logger.warn(
+                    "Rate limited rolling, retrying in {retry_after:.3f}s",
+                    retry_after=retry_after,
+                )
+                await sleep(retry_after)
+
+        except Exception as exc:
+            await logger.error("Could not roll", exc=exc)
+
+        finally:
+            self.rolling = False
+
+    @staticmethod
+    def retry_after(exc: discord.HTTPException) -> float:
+        # As the library reads it, from the 429's body, which HTTPException does
+        # not keep, so from the headers Discord sends along with it instead
+        headers = exc.response.headers
+
+        for header in ("Retry-After", "X-RateLimit-Reset-After"):
             try:
-                await self.config.load()
+                return float(headers[header])
+
+            except (KeyError, ValueError):
+                continue
 
-            except Exception as exc:
-                await logger.warn("Unsuccessful config reload", exc=exc)
+        return 1.0
 
-    async def event_benchmark(self):
-        await self.eventmgr.benchmark()
+    async def reset_claim(self):
         await logger.info(
-            f"Benchmarked EventManager, with an overhead of {self.eventmgr.overhead}s"
+            "Claim reset, next at {at}",
+            at=datetime.fromtimestamp(self.calendar.claims(time())[0]),
         )
 
+    async def sync_time(self):
+        await self.wait_until_ready()
+        channel = self.get_channel(self.config.get("server.channel")[0])
+
+        if channel is None:
+            await logger.warn("Could not find the channel to sync time in")
+        else:
+            await channel.send("$tu")
+
+    @contextmanager
+    def phase(self, name: str):
+        stime = monotonic()
+
+        try:
+            yield
+
+        finally:
+            self.phases[name] = monotonic() - stime
+
     async def bootstrap(self):
+        self.phases = {"imports": IMPORTED - STARTED}
+
         # Logger Installation
         kutils.logger = logger
 
         # Event Manager
         self.eventmgr = EventManager()
-        await self.eventmgr.benchmark()
-        await logger.info(
-            f"Benchmarked EventManager, with an overhead of {self.eventmgr.overhead}s"
-        )
-
-        loop = get_event_loop()
-        loop.create_task(self.eventmgr.dispatcher())
+        self.eventmgr.register("reset_roll", self.reset_roll)
+        self.eventmgr.register("reset_claim", self.reset_claim)
+        self.eventmgr.register("sync_time", self.sync_time)
+        self.eventmgr.register("roll", self.roll)
 
         # Configuration
         self.config = kutils.Config()
-        await self.config.init()
-        await self.config.load()
-
-        # Events
-        await self.eventmgr.dispatch(
-            type=EventType.CONFIG_RELOAD,
-            call=self.event_reloader,
-            at=timedelta(minutes=30),
-            recur=True,
-            delta=timedelta(minutes=30),
-        )
 
-        await self.eventmgr.dispatch(
-            type=EventType.EVENTMGR_BENCH,
-            call=self.event_benchmark,
-            at=timedelta(minutes=10),
-            recur=True,
-            delta=timedelta(minutes=10),
-        )
+        with self.phase("config load"):
+            await self.config.load()
+
+        loop = get_event_loop()
+        self.classifier = kparse.Classifier()
+        self.budget = kutils.TokenBucket(0)
+        self.command_latency: Dict[str, kstats.QuantileSketch] = {}
+        self.rolling = False
+        self.stats = kstats.Stats(Path(__file__).parent.joinpath("stats.json"))
+        await self.stats.load()
+        loop.create_task(self.stats.snapshotter())
+        self.configure()
+        await kutils.alerter.load()
+
+        # Restored only now, as the restored events may call into all of the above,
+        # though not dispatched until the dispatcher is started below
+        with self.phase("event restore"):
+            await self.eventmgr.restore(
+                kutils.Journal(Path(__file__).parent.joinpath("events.journal"))
+            )
 
-    async def roll_parse(self, message: discord.Message):
-        embed: discord.Embed = message.embeds[0]
-        description: str = embed.description.splitlines()  # type: ignore
-        series = description[0]
-        kakera = 0
+        await self.schedule_resets(restored=True)
 
-        for line in description:
-            if "<:kakera:469835869059153940>" in line:
-                try:
-                    for sub in line.split("**"):
-                        try:
-                            kakera = int(sub)
+        # Rolls left in the current window are unknown, so assume all of them
+        self.budget.refill()
+
+        loop.create_task(self.eventmgr.dispatcher())
+
+        if self.config.get("dispatch.roll.auto") and not self.eventmgr.of_type(
+            EventType.ROLL
+        ):
+            await self.eventmgr.dispatch(EventType.ROLL, self.roll, at=timedelta())
 
-                        except Exception:
-                            pass
+        # Roll History
+        self.store = kstore.RollStore(Path(__file__).parent.joinpath("rolls.db"))
+        await self.store.open()
 
-                except Exception as exc:
-                    await logger.warn("?", exc=exc)
+        self.watcher = kutils.Watcher(self.config.path, self.event_reloader)
+        self.watcher.start()
+        self.config.watcher = self.watcher
+
+        self.phases["bootstrap"] = monotonic() - STARTED - self.phases["imports"]
+        self.connecting = monotonic()
+
+    async def roll_parse(self, message: discord.Message, record: kparse.RollRecord):
+        targets: kutils.TargetIndex = self.config.targets  # type: ignore
 
         if (
-            embed.author.name in await self.config.get("target.roll.character")  # type: ignore
-            or series in await self.config.get("target.roll.series")  # type: ignore
-            or kakera >= await self.config.get("target.roll.kakera")  # type: ignore
+            targets.character(record.name)
+            or targets.series(record.series)
+            or record.kakera >= self.config.get("target.roll.kakera")
         ):
-            wait_min, wait_max = await self.config.get("target.roll.delay")  # type: ignore
+            wait_min, wait_max = self.config.get("target.roll.delay")
             await sleep(uniform(wait_min, wait_max))
             await message.add_reaction("🍞")
+            self.stats.target()
+
+        elif near := targets.near(record.name):
+            await logger.waifu(
+                "Rolled {character} <{series}> [{kakera}], "
+                "near miss of target {near}",
+                event="ROLL",
+                character=record.name,
+                series=record.series,
+                kakera=record.kakera,
+                near=near,
+            )
 
         else:
-            await logger.waifu(f"Rolled {embed.author.name} <{series}> [{kakera}]")
+            await logger.waifu(
+                "Rolled {character} <{series}> [{kakera}]",
+                event="ROLL",
+                character=record.name,
+                series=record.series,
+                kakera=record.kakera,
+            )
 
     async def parse(self, message: discord.Message):
+        embed = message.embeds[0] if message.embeds else None
+        kind = self.classifier.classify(
+            message.channel.id,
+            message.content,
+            embed.description if embed is not None else None,
+        )
+
         if (
-            await self.config.get("dispatch.claim.auto")
-            and len(message.embeds) > 0
-            and isinstance(message.embeds[0], discord.Embed)
-            and isinstance(message.embeds[0].description, str)
-            and isinstance(message.embeds[0].author.name, str)
-            and not (
-                # TODO: Remove/rework this once kakera claim tracking is implemented
-                isinstance(footer := message.embeds[0].footer.text, str)
-                and "Belongs to" in footer
-            )
-            and any(
-                [
-                    "React with any emoji to claim!" in message.embeds[0].description,
-                    "Wished by" in message.content,
-                    "<:kakera:469835869059153940>"
-                    in message.embeds[0].description.splitlines()[-1],
-                ]
+            kind is kparse.MessageKind.ROLL
+            and isinstance(embed.author.name, str)  # type: ignore
+            and (
+                record := kparse.parse_roll(
+                    embed.author.name,  # type: ignore
+                    embed.description,  # type: ignore
+                    message.content,
+                    embed.footer.text,  # type: ignore
+                )
             )
+            is not None
+        ):
+            self.store.roll(record)
+            self.stats.roll(record)
+
+            # TODO: Remove/rework this once kakera claim tracking is implemented
+            if self.config.get("dispatch.claim.auto") and not record.claimed:
+                await self.roll_parse(message, record)
+
+        elif (
+            kind is kparse.MessageKind.MARRIAGE
+            and (married := kparse.parse_marriage(message.content)) is not None
+        ):
+            await self.claim_parse(*married)
+
+        elif (
+            kind is kparse.MessageKind.TIMERS
+            and not self.calendar.derivable
+            and (minutes := kparse.parse_timers(message.content)) is not None
         ):
-            await self.roll_parse(message)
+            self.calendar.observe(time() + minutes * 60)
+            self.stats.offset = self.calendar.claim_phase  # type: ignore
+            await self.schedule_claims()
 
-        elif "are now married!" in message.content:
-            await self.claim_parse(message)
+        elif kind is kparse.MessageKind.ROLL_LIMIT and message.content.startswith(
+            f"**{self.user.display_name}**"
+        ):
+            # Out of sync, e.g. on start up, with rolls spent before
+            self.budget.drain()
 
-    async def claim_parse(self, message: discord.Message):
-        bride = message.content.split("**")[3]
+    async def claim_parse(self, user: str, bride: str):
+        self.store.claim(user, bride)
 
-        if bride in self.config.get("target.roll.character"):  # type: ignore
+        if self.config.targets.character(bride):  # type: ignore
             targeted = True
 
         else:
             targeted = False
 
-        if message.content.split("**")[1] == self.user.name:
-            await logger.waifu(mesg := f"Claimed {bride}!")
+        self.stats.claim(own=user == self.user.name, stolen=targeted)
+
+        if user == self.user.name:
+            await logger.waifu("Claimed {character}!", character=bride)
             await kutils.alert()
-            await kutils.notify(mesg)
+            await kutils.notify(f"Claimed {bride}!")
 
         elif targeted:
-            await logger.waifu(mesg := f"Stolen: {bride}")
+            await logger.waifu("Stolen: {character}", character=bride)
             await kutils.alert()
-            await kutils.notify(mesg)
+            await kutils.notify(f"Stolen: {bride}")
 
     async def on_ready(self):
-        await logger.info(f"Ready as {self.user}.")
+        if "gateway connect" not in self.phases:
+            self.phases["gateway connect"] = monotonic() - self.connecting
+            self.phases["cold start"] = monotonic() - STARTED
+
+        await logger.info(
+            "Ready as {user}, {elapsed:.3f}s after start.",
+            user=str(self.user),
+            elapsed=monotonic() - STARTED,
+        )
+
+        if self.profiling:
+            await self.close()
+
+    def profile(self, threshold: Optional[float]) -> int:
+        # Prints the time taken by every start up phase, returning 1 should the cold
+        # start have taken longer than the threshold
+        for name, elapsed in self.phases.items():
+            print(f"{name:<16} {elapsed * 1000:>10.3f} ms")
+
+        if threshold is not None and self.phases["cold start"] > threshold:
+            print(f"Cold start exceeded the threshold of {threshold * 1000:.3f} ms")
+            return 1
+
+        return 0
 
     async def on_message(self, message: discord.Message):
         if (
-            message.author.id == self.user.id and message.content.startswith("kmra ")
+            message.author.id == self.user.id
+            and message.content.startswith(COMMAND_PREFIX)
         ) or (
             message.content == "kmra status"
-            and await self.config.get("commands.statusPublic")
+            and self.config.get("commands.statusPublic")
         ):
             if (retcode := await self.command_exec(message)) == 0:
                 await message.add_reaction(
-                    str(await self.config.get("commands.emojiSuccess"))
+                    str(self.config.get("commands.emojiSuccess"))
                 )
 
             elif retcode == 1:
                 await message.add_reaction(
-                    str(await self.config.get("commands.emojiInvalid"))
+                    str(self.config.get("commands.emojiInvalid"))
                 )
 
             elif retcode == 2:
                 await message.add_reaction(
-                    str(await self.config.get("commands.emojiFailure"))
+                    str(self.config.get("commands.emojiFailure"))
                 )
 
         if message.author.id == MUDAE_AID:
             await self.parse(message)
 
 
-async def main():
+async def main(profiling: bool = False, threshold: Optional[float] = None):
     kmra = Klaimera()
+    kmra.profiling = profiling
 
     print("Klaimera version 0.0.1\n")
 
     try:
         await kmra.bootstrap()
-        await kmra.start(await kmra.config.get("user.token"))  # type: ignore
+        await kmra.start(kmra.config.get("user.token"))
 
     except Exception as exc:
         await logger.fatal("Error initalising the bot", exc=exc)
 
     else:
-        await kmra.config.file.close()
-        exit(0)
+        kmra.watcher.stop()
+        await kmra.config.flush()
+        await kmra.store.close()
+        await kmra.stats.save()
+        await logger.close()
+        exit(kmra.profile(threshold) if profiling else 0)
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Klaimera, for Mudae.")
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Exit once connected, printing how long every start up phase took",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        help="Exit with 1 if the cold start took longer, in seconds",
+    )
+    args = parser.parse_args()
+
+    from uvloop import install
+
     install()
-    run(main())
+    run(main(args.profile, args.threshold))
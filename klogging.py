@@ -1,10 +1,75 @@
-from typing import Optional
-from inspect import stack
+from typing import Any, Deque, Dict, Iterable, Iterator, List, Optional, Tuple
+from collections import deque
 from pathlib import Path
+from heapq import merge
 from time import time
 
 import aiofiles
+import argparse
+import asyncio
 import traceback
+import shutil
+import json
+import gzip
+import sys
+
+Record = Tuple[int, str, float, str, Optional[Exception], Dict[str, Any]]
+
+
+class History:
+    # Ring buffer of the last `capacity` formatted records, with an index per level
+    # so the last N records at or above a level can be found without a full scan.
+    # Index entries older than the ring are ignored rather than evicted eagerly.
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.count = 0
+        self.records: Deque[Tuple[int, str]] = deque(maxlen=capacity)
+        self.levels: Dict[int, Deque[Tuple[int, str]]] = {
+            level: deque(maxlen=capacity) for level in Logger.level_map
+        }
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def append(self, level: int, text: str) -> None:
+        self.count += 1
+        self.records.append(entry := (self.count, text))
+        self.levels[level].append(entry)
+
+    def resize(self, capacity: int) -> None:
+        if capacity != self.capacity:
+            self.capacity = capacity
+            self.records = deque(self.records, maxlen=capacity)
+            self.levels = {
+                level: deque(entries, maxlen=capacity)
+                for level, entries in self.levels.items()
+            }
+
+    def last(self, count: int, level: int = 0) -> List[str]:
+        # Oldest first, at most `count` records at or above `level`
+        if level <= min(self.levels):
+            entries: Iterable[Tuple[int, str]] = reversed(self.records)
+        else:
+            entries = merge(
+                *(
+                    reversed(entries)
+                    for index, entries in self.levels.items()
+                    if index >= level
+                ),
+                key=lambda entry: -entry[0],
+            )
+
+        oldest = self.count - len(self.records)
+        found: List[str] = []
+
+        for number, text in entries:
+            if number <= oldest or len(found) >= count:
+                break
+
+            found.append(text)
+
+        return found[::-1]
 
 
 class Logger:
@@ -17,45 +82,111 @@ class Logger:
         5: "FATAL",
     }
 
+    # Records are queued by log() and written out by a single background task, in
+    # one write per flush interval or per batch of records, whichever comes first.
+    flush_interval = 0.25
+    batch_max = 256
+    queue_max = 4096
+
+    # The log file is rotated into a new segment once it reaches either limit, and
+    # past segments are gzipped in an executor, oldest pruned beyond the retention.
+    rotate_size = 16 * 1024 * 1024
+    rotate_age = 24 * 60 * 60
+    retain_size = 256 * 1024 * 1024
+
     def __init__(self):
-        self.log_file_path = (
-            Path(__file__).absolute().parent.joinpath(f"logs/{int(time())}.log")
-        )
+        self.log_dir = Path(__file__).absolute().parent.joinpath("logs")
+        self.log_file_path = self.log_dir.joinpath(f"{int(time())}.log")
+        self.log_file_size = 0
+        self.log_file_started = time()
+        self.rotator: Optional[asyncio.Future] = None
 
         self.log_level = -1
-        self.log_history = []
-        self.log_history_max = 100
+        self.structured = False
+        self.history = History(100)
 
-        if not self.log_file_path.parent.exists():
+        # NOTE: Created on first use by log(), as the logger is made before the loop.
+        self.queue: asyncio.Queue = None  # type: ignore
+        self.full: asyncio.Event = None  # type: ignore
+        self.lock: asyncio.Lock = None  # type: ignore
+        self.writer: Optional[asyncio.Task] = None
+        self.pending: List[Record] = []
+        self.dropped = 0
+
+        if not self.log_dir.exists():
             try:
-                self.log_file_path.parent.mkdir()
+                self.log_dir.mkdir()
 
             except Exception as e:
                 print(
-                    f"Could not make log directory {self.log_file_path}."
+                    f"Could not make log directory {self.log_dir}."
                     f"\n\n{e.__class__.__name__}: {e}"
                 )
                 traceback.print_tb(e.__traceback__)
                 exit(-1)
 
-    async def log(self, text: str, level: int = 1, exc: Exception = None) -> None:
+    async def log(
+        self, text: str, level: int = 1, exc: Exception = None, **fields: Any
+    ) -> None:
+        # With fields given, text is a str.format() template for them, only ever
+        # formatted once the record is written out.
         if level < self.log_level:
             return None
 
-        if not self.log_file_path.exists():
-            self.log_file = await aiofiles.open(self.log_file_path, "w")
+        try:
+            # log() <- debug(), info(), ... <- caller
+            caller = sys._getframe(2).f_code.co_name
 
-        ctime = f"{time():.2f}"
+        except ValueError:
+            caller = ""
+
+        if self.writer is None:
+            self.queue = asyncio.Queue(self.queue_max)
+            self.full = asyncio.Event()
+            self.lock = asyncio.Lock()
+            self.writer = asyncio.get_running_loop().create_task(self.write())
 
         try:
-            _stack = stack()
-            caller = f"{_stack[2].frame.f_code.co_name}"
+            self.queue.put_nowait((level, caller, time(), text, exc, fields))
 
-        except Exception:
-            caller = ""
+        except asyncio.QueueFull:
+            self.dropped += 1
 
-        finally:
-            del _stack
+        else:
+            if self.queue.qsize() >= self.batch_max:
+                self.full.set()
+
+    async def write(self) -> None:
+        while True:
+            # Held in pending rather than a local, so that a flush() meanwhile still
+            # writes it out ahead of anything queued after it.
+            self.pending.append(await self.queue.get())
+
+            try:
+                await asyncio.wait_for(self.full.wait(), self.flush_interval)
+
+            except asyncio.TimeoutError:
+                pass
+
+            self.full.clear()
+
+            try:
+                await self.emit()
+
+            except Exception as e:
+                print(f"Could not write logs.\n\n{e.__class__.__name__}: {e}")
+
+    def format(self, record: Record) -> Tuple[List[str], List[str]]:
+        # Returns the lines printed, and the lines written to the log file
+        level, caller, ctime, text, exc, fields = record
+
+        if fields:
+            try:
+                text = text.format(**fields)
+
+            except Exception:
+                # A template not matching its fields loses nothing but the formatting
+                text = f"{text} {fields!r}"
 
         if "\n" in text:
             _text = text.split("\n")
@@ -64,53 +195,255 @@ class Logger:
         else:
             _text = []
 
-        header = f"[{self.level_map[level]} {caller} {ctime}]"
+        header = f"[{self.level_map[level]} {caller} {ctime:.2f}]"
 
         if exc:
-            mesg = f"{header} {text} <- {exc.__class__.__name__}: {exc}\n"
+            mesg = f"{header} {text} <- {exc.__class__.__name__}: {exc}"
         else:
             mesg = f"{header} {text}"
 
-        print(mesg)
-        await self.log_file.write(mesg + "\n")
-        self.log_history.append(mesg)
+        printed = [mesg]
 
         if _text:
             padding = " " * (len(header) + 1)
-
-            for line in _text[1:]:
-                print(f"{padding}{line}")
-                await self.log_file.write(_lmesg := f"{padding}{line}\n")
-                self.log_history.append(_lmesg)
+            printed.extend(f"{padding}{line}" for line in _text[1:])
 
         if exc:
             tb_text = traceback.format_exception(None, exc, exc.__traceback__)
-            await self.log_file.write(f"{exc.__class__.__name__}: {exc}\n")
-            for line in tb_text:
-                await self.log_file.write(f"{line}\n")
 
-        await self.log_file.flush()
+        if self.structured:
+            structured: Dict[str, Any] = {
+                "time": ctime,
+                "level": self.level_map[level],
+                "caller": caller,
+                "message": "\n".join([text, *_text[1:]]),
+                "fields": fields,
+            }
+
+            if exc:
+                structured["exc"] = {
+                    "type": exc.__class__.__name__,
+                    "message": str(exc),
+                    "traceback": "".join(tb_text),
+                }
+
+            return printed, [json.dumps(structured, default=str)]
+
+        written = list(printed)
+
+        if exc:
+            written.append(f"{exc.__class__.__name__}: {exc}")
+            written.extend(line.rstrip("\n") for line in tb_text)
+
+        return printed, written
 
-        if len(self.log_history) > self.log_history_max:
-            self.log_history = self.log_history[-self.log_history_max :]
+    async def emit(self) -> None:
+        async with self.lock:
+            records, self.pending = self.pending, []
 
-    async def debug(self, message: str, exc: Optional[Exception] = None) -> None:
-        await self.log(message, level=0, exc=exc)
+            while not self.queue.empty():
+                records.append(self.queue.get_nowait())
 
-    async def info(self, message: str, exc: Optional[Exception] = None) -> None:
-        await self.log(message, level=1, exc=exc)
+            if self.dropped:
+                records.append(
+                    (
+                        4,
+                        "log",
+                        time(),
+                        "Dropped {dropped} log record(s)",
+                        None,
+                        {"dropped": self.dropped},
+                    )
+                )
+                self.dropped = 0
+
+            if not records:
+                return
+
+            printed: List[str] = []
+            written: List[str] = []
+
+            for record in records:
+                _printed, _written = self.format(record)
+                printed.extend(_printed)
+                written.extend(_written)
+                self.history.append(record[0], "\n".join(_printed))
+
+            print("\n".join(printed))
+
+            text = "\n".join(written) + "\n"
+
+            if self.log_file_path.exists() and (
+                self.log_file_size + len(text) > self.rotate_size
+                or time() - self.log_file_started > self.rotate_age
+            ):
+                await self.rotate()
+
+            if not self.log_file_path.exists():
+                self.log_file = await aiofiles.open(self.log_file_path, "w")
+                self.log_file_size = 0
+                self.log_file_started = time()
+
+                # Segments left by past runs, which otherwise only a rotation in this
+                # one would get to, and frequent restarts may never reach
+                if self.rotator is None:
+                    self.rotator = asyncio.get_running_loop().run_in_executor(
+                        None,
+                        self.compress,
+                        self.log_dir,
+                        self.log_file_path,
+                        self.retain_size,
+                    )
+
+            await self.log_file.write(text)
+            await self.log_file.flush()
+            self.log_file_size += len(text)
+
+    async def rotate(self) -> None:
+        await self.log_file.close()
+
+        stamp = int(time())
+        segment = self.log_dir.joinpath(f"{stamp}.log")
+        number = 0
+
+        while segment.exists() or segment.with_suffix(".log.gz").exists():
+            number += 1
+            segment = self.log_dir.joinpath(f"{stamp}-{number}.log")
+
+        self.log_file_path = segment
+
+        if self.rotator is None or self.rotator.done():
+            self.rotator = asyncio.get_running_loop().run_in_executor(
+                None, self.compress, self.log_dir, segment, self.retain_size
+            )
+
+    @staticmethod
+    def compress(log_dir: Path, current: Path, retain_size: int) -> None:
+        # Gzips every past segment, then prunes the oldest ones until all logs fit
+        # within retain_size. The current segment is never touched.
+        for segment in log_dir.glob("*.log"):
+            if segment == current:
+                continue
+
+            with segment.open("rb") as source, gzip.open(
+                segment.with_suffix(".log.gz"), "wb"
+            ) as target:
+                shutil.copyfileobj(source, target)
+
+            # Keeping the segment's times, as the oldest are pruned first by them
+            shutil.copystat(segment, segment.with_suffix(".log.gz"))
+            segment.unlink()
+
+        segments = sorted(
+            (segment.stat().st_mtime, segment.stat().st_size, segment)
+            for segment in log_dir.glob("*.log.gz")
+        )
+        total = sum(size for _, size, _ in segments)
+
+        if current.exists():
+            total += current.stat().st_size
 
-    async def waifu(self, message: str, exc: Optional[Exception] = None) -> None:
-        await self.log(message, level=2, exc=exc)
+        for _, size, segment in segments:
+            if total <= retain_size:
+                break
 
-    async def error(self, message: str, exc: Optional[Exception] = None) -> None:
-        await self.log(message, level=3, exc=exc)
+            segment.unlink()
+            total -= size
 
-    async def warn(self, message: str, exc: Optional[Exception] = None) -> None:
-        await self.log(message, level=4, exc=exc)
+    async def flush(self) -> None:
+        if self.writer is not None:
+            await self.emit()
 
-    async def fatal(self, message: str, exc: Optional[Exception] = None) -> None:
-        await self.log(message, level=5, exc=exc)
+    async def close(self) -> None:
+        if self.writer is not None:
+            self.writer.cancel()
+            await self.flush()
+            self.writer = None
+
+        if self.rotator is not None:
+            await self.rotator
+
+    async def debug(
+        self, message: str, exc: Optional[Exception] = None, **fields: Any
+    ) -> None:
+        await self.log(message, level=0, exc=exc, **fields)
+
+    async def info(
+        self, message: str, exc: Optional[Exception] = None, **fields: Any
+    ) -> None:
+        await self.log(message, level=1, exc=exc, **fields)
+
+    async def waifu(
+        self, message: str, exc: Optional[Exception] = None, **fields: Any
+    ) -> None:
+        await self.log(message, level=2, exc=exc, **fields)
+
+    async def error(
+        self, message: str, exc: Optional[Exception] = None, **fields: Any
+    ) -> None:
+        await self.log(message, level=3, exc=exc, **fields)
+
+    async def warn(
+        self, message: str, exc: Optional[Exception] = None, **fields: Any
+    ) -> None:
+        await self.log(message, level=4, exc=exc, **fields)
+
+    async def fatal(
+        self, message: str, exc: Optional[Exception] = None, **fields: Any
+    ) -> None:
+        await self.log(message, level=5, exc=exc, **fields)
+        await self.flush()
+
+
+def query(
+    path: Path,
+    level: int = 0,
+    event: Optional[str] = None,
+    character: Optional[str] = None,
+) -> Iterator[Dict[str, Any]]:
+    # Streams the records of a structured log matching every filter given, reading
+    # it a line at a time. Lines that are not structured records are skipped.
+    levels = {name: number for number, name in Logger.level_map.items()}
+
+    if character is not None:
+        character = character.casefold()
+
+    with gzip.open(path, "rt") if path.suffix == ".gz" else path.open() as file:
+        for line in file:
+            if not line.startswith("{"):
+                continue
+
+            try:
+                record = json.loads(line)
+
+            except ValueError:
+                continue
+
+            fields = record.get("fields", {})
+
+            if (
+                levels.get(record.get("level"), 0) >= level
+                and (event is None or fields.get("event") == event)
+                and (
+                    character is None
+                    or str(fields.get("character", "")).casefold() == character
+                )
+            ):
+                yield record
 
 
 logger = Logger()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query a structured Klaimera log.")
+    parser.add_argument("path", type=Path)
+    parser.add_argument("--level", choices=Logger.level_map.values(), default="DEBUG")
+    parser.add_argument("--event", help="EventType name, e.g. ROLL")
+    parser.add_argument("--character")
+    args = parser.parse_args()
+
+    level = {name: number for number, name in Logger.level_map.items()}[args.level]
+
+    for record in query(args.path, level, args.event, args.character):
+        print(json.dumps(record))
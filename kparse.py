@@ -0,0 +1,152 @@
+from typing import Any, Iterable, NamedTuple, Optional, Tuple
+from enum import Enum
+import re
+
+KAKERA_EMOJI = "<:kakera:469835869059153940>"
+CLAIM_PROMPT = "React with any emoji to claim!"
+
+wish_pattern = re.compile(r"Wished by (?P<wishers>.+)")
+marriage_pattern = re.compile(
+    r"\*\*(?P<user>.+?)\*\* and \*\*(?P<bride>.+?)\*\* are now married!"
+)
+timers_pattern = re.compile(
+    r"(?:next claim reset is in|can't claim for another) "
+    r"\*\*(?:(?P<hours>\d+)h )?(?P<minutes>\d+)\*\* min"
+)
+
+
+class MessageKind(Enum):
+    ROLL = 0
+    MARRIAGE = 1
+    KAKERA = 2
+    TIMERS = 3
+    ROLL_LIMIT = 4
+    OTHER = 5
+
+
+class Classifier:
+    # Sorts messages from Mudae into kinds with the cheapest and most selective
+    # checks first, counting how many pass and are rejected at every stage.
+
+    stages = ("channel", "embed", "marker")
+
+    def __init__(self, channels: Iterable[int] = ()) -> None:
+        self.channels = frozenset(channels)
+        self.passed = dict.fromkeys(self.stages, 0)
+        self.rejected = dict.fromkeys(self.stages, 0)
+
+    def __str__(self) -> str:
+        return "\n".join(
+            f"{stage}: {self.passed[stage]} passed, {self.rejected[stage]} rejected"
+            for stage in self.stages
+        )
+
+    def classify(self, channel: int, content: str, description: Any) -> MessageKind:
+        if channel not in self.channels:
+            self.rejected["channel"] += 1
+            return MessageKind.OTHER
+
+        self.passed["channel"] += 1
+
+        if not isinstance(description, str):
+            self.rejected["embed"] += 1
+
+            if "are now married!" in content:
+                kind = MessageKind.MARRIAGE
+            elif KAKERA_EMOJI in content:
+                kind = MessageKind.KAKERA
+            elif "claim reset is in" in content or "claim for another" in content:
+                kind = MessageKind.TIMERS
+            elif "roulette is limited to" in content:
+                kind = MessageKind.ROLL_LIMIT
+            else:
+                kind = MessageKind.OTHER
+
+        else:
+            self.passed["embed"] += 1
+
+            if (
+                KAKERA_EMOJI in description
+                or CLAIM_PROMPT in description
+                or "Wished by" in content
+            ):
+                kind = MessageKind.ROLL
+            else:
+                kind = MessageKind.OTHER
+
+        if kind is MessageKind.OTHER:
+            self.rejected["marker"] += 1
+        else:
+            self.passed["marker"] += 1
+
+        return kind
+
+
+class RollRecord(NamedTuple):
+    name: str
+    series: str
+    kakera: int
+    wished_by: Tuple[str, ...]
+    claimed: bool
+    owner: Optional[str]
+    claimable: bool
+
+
+def parse_roll(
+    name: str, description: str, content: str = "", footer: Any = None
+) -> Optional[RollRecord]:
+    # Returns None for embeds that are not rolls, i.e. that neither prompt for a
+    # claim, are wished for, nor end on a kakera value. Markers are located with
+    # plain substring searches, and the kakera value is read from the "**N**" just
+    # before the last kakera emoji.
+    kakera = 0
+    kakera_last = False
+
+    if (emoji := description.rfind(KAKERA_EMOJI)) >= 0:
+        kakera_last = emoji > description.rfind("\n")
+        close = description.rfind("**", 0, emoji)
+        digits = description[description.rfind("**", 0, close) + 2 : close]
+
+        if digits.isdigit():
+            kakera = int(digits)
+
+    claimable = CLAIM_PROMPT in description
+
+    if "Wished by" in content and (wish := wish_pattern.search(content)):
+        wished_by = tuple(wish.group("wishers").split())
+    else:
+        wished_by = ()
+
+    if not (claimable or wished_by or kakera_last):
+        return None
+
+    if isinstance(footer, str) and (belongs := footer.find("Belongs to ")) >= 0:
+        owner: Optional[str] = footer[belongs + 11 :].partition(" ~~ ")[0]
+    else:
+        owner = None
+
+    return RollRecord(
+        name,
+        description.partition("\n")[0],
+        kakera,
+        wished_by,
+        owner is not None,
+        owner,
+        claimable,
+    )
+
+
+def parse_marriage(content: str) -> Optional[Tuple[str, str]]:
+    # Returns who married whom from a marriage announcement
+    if (married := marriage_pattern.search(content)) is None:
+        return None
+
+    return married.group("user"), married.group("bride")
+
+
+def parse_timers(content: str) -> Optional[int]:
+    # Returns the minutes until the next claim reset from a '$tu' reply
+    if (timers := timers_pattern.search(content)) is None:
+        return None
+
+    return int(timers.group("hours") or 0) * 60 + int(timers.group("minutes"))
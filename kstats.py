@@ -0,0 +1,206 @@
+from typing import Any, Deque, Dict, List, Optional, Tuple
+from collections import deque
+from math import ceil, log
+from pathlib import Path
+from time import time
+import asyncio
+import json
+
+from aiofiles import open
+
+import kparse
+import kutils
+
+
+class HeavyHitters:
+    # Misra-Gries summary: approximate counts of the most frequent keys in at most
+    # `capacity` counters. Each key's count is under by at most total / capacity, and
+    # the decrement of every counter on overflow is paid for by the increments, so
+    # updates are amortized O(1).
+
+    def __init__(self, capacity: int = 64) -> None:
+        self.capacity = capacity
+        self.counts: Dict[str, int] = {}
+        self.total = 0
+
+    def add(self, key: str) -> None:
+        self.total += 1
+
+        if key in self.counts:
+            self.counts[key] += 1
+        elif len(self.counts) < self.capacity:
+            self.counts[key] = 1
+        else:
+            self.counts = {
+                key: count - 1 for key, count in self.counts.items() if count > 1
+            }
+
+    def top(self, count: int) -> List[Tuple[str, int]]:
+        return sorted(self.counts.items(), key=lambda item: -item[1])[:count]
+
+
+class QuantileSketch:
+    # Histogram over logarithmic buckets, each value landing in the bucket of
+    # ceil(log_gamma(value)), so any quantile is within `accuracy` of the real value
+    # relative to it. Kakera values span a few orders of magnitude at most, which
+    # keeps the buckets to a few hundred.
+
+    def __init__(self, accuracy: float = 0.02) -> None:
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.buckets: Dict[int, int] = {}
+        self.count = 0
+        self.zeros = 0
+
+    def add(self, value: float) -> None:
+        self.count += 1
+
+        if value <= 0:
+            self.zeros += 1
+        else:
+            bucket = ceil(log(value, self.gamma))
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+
+        rank = q * (self.count - 1)
+
+        if rank < self.zeros:
+            return 0.0
+
+        seen = self.zeros
+
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+
+            if seen > rank:
+                return 2 * self.gamma**bucket / (self.gamma + 1)
+
+        return 0.0
+
+
+class Stats:
+    # Aggregates of everything rolled and claimed, each updated in O(1) and fixed
+    # in size, so 'kmra status' renders without going through any history. They are
+    # snapshotted to a small JSON file whenever changed, at most once an interval.
+
+    windows_max = 24
+    snapshot_interval = 60.0
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.rolls = 0
+        self.claims = 0
+        self.stolen = 0
+        self.targeted = 0
+        self.series = HeavyHitters()
+        self.kakera = QuantileSketch()
+        self.windows: Deque[List[int]] = deque(maxlen=self.windows_max)
+        self.period = 3 * 60 * 60
+        self.offset = 0
+        self.dirty = False
+
+    def window(self, at: Optional[float]) -> List[int]:
+        # [window number, rolls, claims] of the claim window `at` falls in
+        number = int(((time() if at is None else at) - self.offset) // self.period)
+
+        if not self.windows or self.windows[-1][0] != number:
+            self.windows.append([number, 0, 0])
+
+        return self.windows[-1]
+
+    def roll(self, record: kparse.RollRecord, at: Optional[float] = None) -> None:
+        self.rolls += 1
+        self.series.add(record.series)
+        self.kakera.add(record.kakera)
+        self.window(at)[1] += 1
+        self.dirty = True
+
+    def target(self) -> None:
+        self.targeted += 1
+        self.dirty = True
+
+    def claim(self, own: bool, stolen: bool, at: Optional[float] = None) -> None:
+        if own:
+            self.claims += 1
+            self.window(at)[2] += 1
+
+        elif stolen:
+            self.stolen += 1
+
+        self.dirty = True
+
+    def render(self, series_max: int = 5) -> str:
+        lines = [
+            f"{self.rolls} rolled, {self.targeted} targeted, {self.claims} claimed, "
+            f"{self.stolen} stolen",
+            "kakera: "
+            + ", ".join(
+                f"p{int(q * 100)} {self.kakera.quantile(q):.0f}"
+                for q in (0.5, 0.9, 0.99)
+            ),
+            "series: "
+            + ", ".join(
+                f"{series} ({count})" for series, count in self.series.top(series_max)
+            ),
+        ]
+
+        if self.windows:
+            _, rolls, claims = self.windows[-1]
+            lines.append(
+                f"claim window: {rolls} rolled, {claims} claimed; over the last "
+                f"{len(self.windows)}, {sum(window[1] for window in self.windows)} "
+                f"rolled, {sum(window[2] for window in self.windows)} claimed"
+            )
+
+        return "\n".join(lines)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "rolls": self.rolls,
+            "claims": self.claims,
+            "stolen": self.stolen,
+            "targeted": self.targeted,
+            "series": self.series.counts,
+            "series_total": self.series.total,
+            "kakera": {str(bucket): n for bucket, n in self.kakera.buckets.items()},
+            "kakera_zeros": self.kakera.zeros,
+            "windows": list(self.windows),
+        }
+
+    def restore(self, snapshot: Dict[str, Any]) -> None:
+        self.rolls = snapshot["rolls"]
+        self.claims = snapshot["claims"]
+        self.stolen = snapshot["stolen"]
+        self.targeted = snapshot["targeted"]
+        self.series.counts = dict(snapshot["series"])
+        self.series.total = snapshot["series_total"]
+        self.kakera.buckets = {
+            int(bucket): n for bucket, n in snapshot["kakera"].items()
+        }
+        self.kakera.zeros = snapshot["kakera_zeros"]
+        self.kakera.count = self.kakera.zeros + sum(self.kakera.buckets.values())
+        self.windows.extend(snapshot["windows"])
+
+    async def load(self) -> None:
+        if not self.path.exists():
+            return
+
+        async with open(self.path, "r") as file:
+            self.restore(json.loads(await file.read()))
+
+    async def save(self) -> None:
+        if self.dirty:
+            self.dirty = False
+            await kutils.write_atomic(self.path, json.dumps(self.snapshot()))
+
+    async def snapshotter(self) -> None:
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+
+            try:
+                await self.save()
+
+            except Exception as e:
+                print(f"Could not snapshot stats.\n\n{e.__class__.__name__}: {e}")
@@ -0,0 +1,178 @@
+from typing import Any, List, Optional, Tuple
+from pathlib import Path
+from time import time
+import asyncio
+import sqlite3
+
+import kparse
+import kutils
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rolls (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    character TEXT NOT NULL,
+    series TEXT NOT NULL,
+    kakera INTEGER NOT NULL,
+    wished INTEGER NOT NULL,
+    owner TEXT
+);
+CREATE TABLE IF NOT EXISTS claims (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    user TEXT NOT NULL,
+    character TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS rolls_character ON rolls (character);
+CREATE INDEX IF NOT EXISTS rolls_series ON rolls (series);
+CREATE INDEX IF NOT EXISTS rolls_kakera ON rolls (kakera);
+CREATE INDEX IF NOT EXISTS rolls_time ON rolls (time);
+CREATE INDEX IF NOT EXISTS claims_character ON claims (character);
+CREATE INDEX IF NOT EXISTS claims_time ON claims (time);
+"""
+
+
+class RollStore:
+    # SQLite history of every roll and claim seen. Rows are buffered in memory and
+    # inserted by a background task in one transaction per flush interval or batch,
+    # with all database work done in an executor so the event loop never blocks.
+    # The "db" executor has a single thread, which owns the connection and so
+    # serializes every insert and query.
+
+    flush_interval = 5.0
+    batch_max = 512
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.connection: Optional[sqlite3.Connection] = None
+        self.rolls: List[Tuple[float, str, str, int, int, Optional[str]]] = []
+        self.claims: List[Tuple[float, str, str]] = []
+        self.inserted = 0
+
+        # NOTE: Created by open(), as the store is made before the loop.
+        self.full: asyncio.Event = None  # type: ignore
+        self.writer: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self.rolls) + len(self.claims)
+
+    def connect(self) -> None:
+        self.connection = sqlite3.connect(self.path, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+
+    async def run(self, func: Any, *args: Any) -> Any:
+        return await kutils.executors["db"].run(func, *args)
+
+    async def open(self) -> None:
+        self.full = asyncio.Event()
+        await self.run(self.connect)
+        self.writer = asyncio.get_running_loop().create_task(self.write())
+
+    async def close(self) -> None:
+        if self.writer is not None:
+            self.writer.cancel()
+            self.writer = None
+
+        if self.connection is not None:
+            await self.flush()
+            await self.run(self.connection.close)
+            self.connection = None
+
+    def roll(self, record: kparse.RollRecord, at: Optional[float] = None) -> None:
+        self.rolls.append(
+            (
+                time() if at is None else at,
+                record.name,
+                record.series,
+                record.kakera,
+                len(record.wished_by),
+                record.owner,
+            )
+        )
+
+        if len(self) >= self.batch_max:
+            self.full.set()
+
+    def claim(self, user: str, character: str, at: Optional[float] = None) -> None:
+        self.claims.append((time() if at is None else at, user, character))
+
+        if len(self) >= self.batch_max:
+            self.full.set()
+
+    def insert(self, rolls: List[tuple], claims: List[tuple]) -> None:
+        with self.connection:  # type: ignore
+            self.connection.execute("BEGIN")  # type: ignore
+            self.connection.executemany(  # type: ignore
+                "INSERT INTO rolls (time, character, series, kakera, wished, owner) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rolls,
+            )
+            self.connection.executemany(  # type: ignore
+                "INSERT INTO claims (time, user, character) VALUES (?, ?, ?)", claims
+            )
+
+    async def write(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self.full.wait(), self.flush_interval)
+
+            except asyncio.TimeoutError:
+                pass
+
+            self.full.clear()
+
+            try:
+                await self.flush()
+
+            except Exception as e:
+                print(f"Could not write roll history.\n\n{e.__class__.__name__}: {e}")
+
+    async def flush(self) -> None:
+        if not len(self):
+            return
+
+        rolls, claims = self.rolls, self.claims
+        self.rolls, self.claims = [], []
+
+        await self.run(self.insert, rolls, claims)
+        self.inserted += len(rolls) + len(claims)
+
+    async def query(self, sql: str, *params: Any) -> List[tuple]:
+        def _internal() -> List[tuple]:
+            return self.connection.execute(sql, params).fetchall()  # type: ignore
+
+        return await self.run(_internal)
+
+    async def top_kakera(self, limit: int = 10) -> List[Tuple[str, str, int]]:
+        return await self.query(
+            "SELECT character, series, kakera FROM rolls "
+            "ORDER BY kakera DESC LIMIT ?",
+            limit,
+        )
+
+    async def series_frequency(self, limit: int = 10) -> List[Tuple[str, int]]:
+        return await self.query(
+            "SELECT series, COUNT(*) AS rolled FROM rolls "
+            "GROUP BY series ORDER BY rolled DESC LIMIT ?",
+            limit,
+        )
+
+    async def claim_rate(
+        self, period: float, offset: float = 0.0, since: float = 0.0
+    ) -> List[Tuple[float, int, int]]:
+        # Rolls and claims per reset window of `period` seconds, windows starting
+        # `offset` seconds past the epoch, as (window start, rolls, claims)
+        return await self.query(
+            "SELECT start, SUM(rolled), SUM(claimed) FROM ("
+            "SELECT CAST((time - ?1) / ?2 AS INTEGER) * ?2 + ?1 AS start, "
+            "1 AS rolled, 0 AS claimed FROM rolls WHERE time >= ?3 "
+            "UNION ALL "
+            "SELECT CAST((time - ?1) / ?2 AS INTEGER) * ?2 + ?1 AS start, "
+            "0 AS rolled, 1 AS claimed FROM claims WHERE time >= ?3"
+            ") GROUP BY start ORDER BY start",
+            offset,
+            period,
+            since,
+        )
@@ -1,58 +1,614 @@
-from typing import Any, Awaitable, Callable, Optional, Tuple, Union
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Coroutine,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+from collections import Counter
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
+from time import monotonic
+from itertools import chain
+from math import ceil
+import ctypes.util
+import subprocess
 import functools
+import threading
 import asyncio
+import ctypes
+import unicodedata
+import shutil
+import struct
+import stat
+import wave
+import json
+import os
 
-from tomlkit import dumps, loads, items
-from playsound import playsound  # type: ignore
-from notify_run import Notify  # type: ignore
+from tomlkit import dumps, loads, items, item as toml_item
 from aiofiles import open
 
 from klogging import Logger
 
-notify_run = Notify()
+notify_run: Any = None
 logger: Optional[Logger] = None
 
 
-def rie(func: Callable) -> Callable:
-    @functools.wraps(func)
-    def wrapper(*args, **kwargs) -> Awaitable:
-        return asyncio.get_running_loop().run_in_executor(
-            None, lambda: func(*args, **kwargs)
+class Executor:
+    # A named, bounded thread pool for blocking work, so that one kind of work
+    # hanging (e.g. a push that never returns) cannot tie up the workers of another.
+    # Calls past `timeout` are cancelled if not yet started and abandoned otherwise.
+    # Queue wait, run time, and how often every worker was busy on submission are
+    # recorded for spotting work starved of workers. A call is pending until its
+    # thread is done with it, so abandoned calls still count as holding a worker.
+
+    def __init__(self, name: str, workers: int, timeout: Optional[float]) -> None:
+        self.name = name
+        self.workers = workers
+        self.timeout = timeout
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix=f"kmra-{name}")
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.running = 0
+        self.completed = 0
+        self.saturated = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.run_total = 0.0
+        self.run_max = 0.0
+
+    def __str__(self) -> str:
+        completed = max(self.completed, 1)
+        return (
+            f"{self.running}/{self.workers} running, {self.pending} in flight, "
+            f"{self.completed} done, {self.saturated} saturated, {self.timeouts} "
+            f"timed out, waited {self.wait_total / completed:.3f}s mean "
+            f"{self.wait_max:.3f}s max, ran {self.run_total / completed:.3f}s mean "
+            f"{self.run_max:.3f}s max"
         )
 
-    return wrapper
+    def call(self, submitted: float, func: Callable, *args: Any) -> Any:
+        started = monotonic()
 
+        with self.lock:
+            self.running += 1
+
+        try:
+            return func(*args)
+
+        finally:
+            ended = monotonic()
+
+            with self.lock:
+                self.running -= 1
+                self.completed += 1
+                self.wait_total += started - submitted
+                self.wait_max = max(self.wait_max, started - submitted)
+                self.run_total += ended - started
+                self.run_max = max(self.run_max, ended - started)
+
+    def done(self, future: Future) -> None:
+        # Called from the worker thread once it is finished with the call, or on
+        # the loop if it was cancelled before ever starting
+        with self.lock:
+            self.pending -= 1
+
+    async def run(self, func: Callable, *args: Any) -> Any:
+        with self.lock:
+            if self.pending >= self.workers:
+                self.saturated += 1
+
+            self.pending += 1
+
+        future = self.pool.submit(self.call, monotonic(), func, *args)
+        future.add_done_callback(self.done)
+
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+
+    def shutdown(self) -> None:
+        self.pool.shutdown(wait=False)
+
+
+executors = {
+    "io": Executor("io", 4, 10.0),
+    "net": Executor("net", 2, 30.0),
+    "audio": Executor("audio", 1, 60.0),
+    "db": Executor("db", 1, None),
+}
 
-async def alert() -> int:
-    try:
-        if (audio_path := Path(__file__).parent.joinpath("alert.wav")).exists():
-            playsound(str(audio_path), block=False)
 
-    except Exception as exc:
-        if logger:
-            await logger.warn("Error playing audio", exc=exc)
+def rie(executor: str) -> Callable[[Callable], Callable]:
+    # Runs the decorated blocking function in the named executor
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs) -> Awaitable:
+            return executors[executor].run(functools.partial(func, *args, **kwargs))
 
-        return 0
+        return wrapper
 
-    else:
-        return 2
+    return decorator
 
 
-async def notify(message: str):
-    @rie
-    def _internal(message: str):
-        notify_run.send(message)
+@rie("io")
+def write_atomic(path: Path, text: str) -> None:
+    # Written out and synced to a temporary file first, then renamed over the
+    # original so a crash can only ever leave either the old or the new file.
+    temp_path = path.with_name(f".{path.name}.tmp")
+
+    with temp_path.open("w") as file:
+        file.write(text)
+        file.flush()
+        os.fsync(file.fileno())
+
+    if path.exists():
+        os.chmod(temp_path, stat.S_IMODE(path.stat().st_mode))
+
+    os.replace(temp_path, path)
+
+    dir_fd = os.open(path.parent, os.O_RDONLY)
 
     try:
-        await _internal(message)
-        return 0
+        os.fsync(dir_fd)
+
+    finally:
+        os.close(dir_fd)
+
+
+class Alerter:
+    # The alert sound is read and decoded once by load(), at start up and on config
+    # reloads, and played from memory by piping its PCM frames to aplay(1). Without
+    # aplay, as off Linux, playsound is the fallback, which reads the file itself on
+    # every play. Either way it is played by a single worker so that sounds never
+    # overlap. Alerts raised while one is playing collapse into one more play after
+    # it, at least `interval` later.
+
+    interval = 1.0
+
+    # aplay sample formats by sample width, 8-bit WAV being the only unsigned one
+    formats = {1: "U8", 2: "S16_LE", 3: "S24_3LE", 4: "S32_LE"}
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.enabled = True
+        self.frames: Optional[bytes] = None
+        self.player: Optional[List[str]] = None
+        self.duration = 0.0
+        self.played = 0
+        self.coalesced = 0
+        self.delay = 0.0
+        self.delay_max = 0.0
+        self.triggered = 0.0
+
+        # NOTE: Created on first use by trigger(), as it is made before the loop.
+        self.pending: asyncio.Event = None  # type: ignore
+        self.worker: Optional[asyncio.Task] = None
+
+    def __str__(self) -> str:
+        return (
+            f"{self.played} played, {self.coalesced} coalesced, {self.delay:.3f}s "
+            f"to play last, {self.delay_max:.3f}s max"
+        )
+
+    @classmethod
+    @rie("io")
+    def read(cls, path: Path) -> Tuple[bytes, float, Optional[List[str]]]:
+        # The frames, their duration, and the aplay command playing them if there
+        # is an aplay to play them with
+        with wave.open(str(path), "rb") as file:
+            frames = file.readframes(file.getnframes())
+            duration = file.getnframes() / file.getframerate()
+            player = None
+
+            if (aplay := shutil.which("aplay")) is not None and (
+                sample := cls.formats.get(file.getsampwidth())
+            ) is not None:
+                player = [
+                    aplay,
+                    "-q",
+                    "-t",
+                    "raw",
+                    "-f",
+                    sample,
+                    "-r",
+                    str(file.getframerate()),
+                    "-c",
+                    str(file.getnchannels()),
+                ]
+
+        return frames, duration, player
+
+    async def load(self) -> None:
+        self.frames = None
+
+        if not self.enabled or not self.path.exists():
+            return
+
+        try:
+            self.frames, self.duration, self.player = await self.read(self.path)
+
+        except Exception as exc:
+            if logger:
+                await logger.warn("Error loading alert audio", exc=exc)
+
+    def trigger(self) -> bool:
+        if not self.enabled:
+            return True
+
+        if self.frames is None:
+            return False
+
+        if self.worker is None:
+            self.pending = asyncio.Event()
+            self.worker = asyncio.get_running_loop().create_task(self.work())
+
+        if self.pending.is_set():
+            self.coalesced += 1
+        else:
+            self.triggered = monotonic()
+            self.pending.set()
+
+        return True
+
+    def play(self) -> None:
+        self.delay = monotonic() - self.triggered
+        self.delay_max = max(self.delay_max, self.delay)
+
+        if self.player is not None:
+            subprocess.run(
+                self.player, input=self.frames, check=True, stderr=subprocess.PIPE
+            )
+            return
+
+        # Imported here, so only ever with audio alerts enabled
+        from playsound import playsound  # type: ignore
+
+        playsound(str(self.path), block=True)
+
+    async def work(self) -> None:
+        while True:
+            await self.pending.wait()
+            self.pending.clear()
+
+            try:
+                await executors["audio"].run(self.play)
+
+            except Exception as exc:
+                if logger:
+                    await logger.warn("Error playing audio", exc=exc)
+
+            else:
+                self.played += 1
+
+            await asyncio.sleep(self.interval)
+
+
+alerter = Alerter(Path(__file__).parent.joinpath("alert.wav"))
+
+
+async def alert() -> int:
+    return 0 if alerter.trigger() else 2
+
+
+class LocalTransport:
+    # Stand-in for notify_run that keeps what would have been pushed, as the tests use
+
+    def __init__(self) -> None:
+        self.sent: List[str] = []
+
+    def __call__(self, message: str) -> None:
+        self.sent.append(message)
+
+
+class Notifier:
+    # Push notifications go through a bounded queue to a single worker. Messages
+    # arriving within `window` of the first are deduplicated and coalesced into one
+    # push, which is retried with exponential backoff on failure.
+
+    window = 2.0
+    queue_max = 64
+    retries = 4
+    backoff = 1.0
+
+    def __init__(self, transport: Callable[[str], None]) -> None:
+        self.transport = transport
+        self.enabled = True
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.failed = 0
+        self.latency = 0.0
+        self.latency_max = 0.0
+
+        # NOTE: Created on first use by push(), as it is made before the loop.
+        self.queue: asyncio.Queue = None  # type: ignore
+        self.worker: Optional[asyncio.Task] = None
+
+    def __str__(self) -> str:
+        return (
+            f"{self.queue.qsize() if self.queue else 0} queued, {self.sent} sent, "
+            f"{self.coalesced} coalesced, {self.dropped} dropped, {self.failed} "
+            f"failed, {self.latency:.3f}s last send, {self.latency_max:.3f}s max"
+        )
+
+    def push(self, message: str) -> bool:
+        if not self.enabled:
+            return True
+
+        if self.worker is None:
+            self.queue = asyncio.Queue(self.queue_max)
+            self.worker = asyncio.get_running_loop().create_task(self.work())
+
+        try:
+            self.queue.put_nowait(message)
+
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+
+        return True
+
+    async def work(self) -> None:
+        loop = asyncio.get_running_loop()
+
+        while True:
+            messages = [await self.queue.get()]
+            deadline = loop.time() + self.window
+
+            while (remaining := deadline - loop.time()) > 0:
+                try:
+                    messages.append(await asyncio.wait_for(self.queue.get(), remaining))
+
+                except asyncio.TimeoutError:
+                    break
+
+            unique = list(dict.fromkeys(messages))
+            self.coalesced += len(messages) - 1
+
+            for attempt in range(self.retries):
+                stime = loop.time()
+
+                try:
+                    await executors["net"].run(self.transport, "\n".join(unique))
+
+                except Exception as exc:
+                    if logger:
+                        await logger.warn(
+                            "Error sending push notification, attempt {attempt}",
+                            exc=exc,
+                            attempt=attempt + 1,
+                        )
+
+                    if attempt + 1 < self.retries:
+                        await asyncio.sleep(self.backoff * 2**attempt)
+
+                else:
+                    self.sent += 1
+                    self.latency = loop.time() - stime
+                    self.latency_max = max(self.latency_max, self.latency)
+                    break
+
+            else:
+                self.failed += 1
+
+
+def send_push(message: str) -> None:
+    # notify_run reads its own config once made, so it is only made for a first push
+    global notify_run
+
+    if notify_run is None:
+        from notify_run import Notify  # type: ignore
+
+        notify_run = Notify()
+
+    notify_run.send(message)
+
+
+notifier = Notifier(send_push)
+
+
+async def notify(message: str) -> int:
+    return 0 if notifier.push(message) else 2
+
+
+class Journal:
+    # Append-only JSON lines log of event records, keyed by handle. A record with
+    # "op" set to "d" (dispatch) makes a handle live, "c" (cancel) retires it. The
+    # file is periodically rewritten as a snapshot of just the live records.
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.pending: List[str] = []
+        self.records = 0
+
+    @staticmethod
+    def encode(record: Dict[str, Any]) -> str:
+        return json.dumps(record, separators=(",", ":"))
+
+    def record(self, **record: Any) -> None:
+        self.pending.append(self.encode(record))
+
+    async def replay(self) -> Dict[int, Dict[str, Any]]:
+        live: Dict[int, Dict[str, Any]] = {}
+        self.records = 0
+
+        if not self.path.exists():
+            return live
+
+        async with open(self.path, "r") as file:
+            lines = (await file.read()).splitlines()
+
+        for line in lines:
+            try:
+                record = json.loads(line)
+
+            except ValueError:
+                # A torn write from a crash can only ever be the last line
+                break
+
+            if record["op"] == "d":
+                live[record["h"]] = record
+            else:
+                live.pop(record["h"], None)
+
+            self.records += 1
+
+        return live
+
+    async def flush(self) -> None:
+        if not self.pending:
+            return
+
+        lines, self.pending = self.pending, []
+
+        async with open(self.path, "a") as file:
+            await file.write("\n".join(lines) + "\n")
+
+        self.records += len(lines)
+
+    async def compact(self, live: Iterable[Dict[str, Any]]) -> None:
+        lines = [self.encode(record) for record in live]
+        await write_atomic(self.path, "".join(line + "\n" for line in lines))
+        self.pending = []
+        self.records = len(lines)
+
+
+class Watcher:
+    # Calls back once a file has settled after being changed, replaced or removed.
+    # Uses inotify(7) on the file's directory where available, so saves by rename are
+    # seen as well, and otherwise falls back to polling stat(2).
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    def __init__(
+        self,
+        path: Path,
+        callback: Callable[[], Coroutine[Any, Any, Any]],
+        debounce: float = 0.5,
+        interval: float = 5.0,
+    ) -> None:
+        self.path = path
+        self.callback = callback
+        self.debounce = debounce
+        self.interval = interval
+
+        self.fd: Optional[int] = None
+        self.poller: Optional[asyncio.Task] = None
+        self.pending: Optional[asyncio.TimerHandle] = None
+        self.signature = self.stat()
 
-    except Exception as exc:
-        if logger:
-            await logger.warn("Error sending push notification", exc=exc)
+    def stat(self) -> Optional[Tuple[int, int, int]]:
+        try:
+            stat = self.path.stat()
 
-        return 2
+        except OSError:
+            return None
+
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def start(self) -> None:
+        loop = asyncio.get_running_loop()
+
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1")
+
+            mask = (
+                self.IN_CLOSE_WRITE
+                | self.IN_MOVED_FROM
+                | self.IN_MOVED_TO
+                | self.IN_CREATE
+                | self.IN_DELETE
+            )
+
+            if libc.inotify_add_watch(fd, bytes(self.path.parent), mask) < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), "inotify_add_watch")
+
+        except (AttributeError, OSError, TypeError):
+            self.poller = loop.create_task(self.poll())
+
+        else:
+            self.fd = fd
+            loop.add_reader(fd, self.read)
+
+    def stop(self) -> None:
+        if self.pending:
+            self.pending.cancel()
+
+        if self.poller:
+            self.poller.cancel()
+
+        if self.fd is not None:
+            asyncio.get_running_loop().remove_reader(self.fd)
+            os.close(self.fd)
+            self.fd = None
+
+    def read(self) -> None:
+        try:
+            buffer = os.read(self.fd, 4096)  # type: ignore
+
+        except BlockingIOError:
+            return
+
+        name = os.fsencode(self.path.name)
+        offset = 0
+
+        # struct inotify_event { int wd; u32 mask, cookie, len; char name[len]; }
+        while offset < len(buffer):
+            _, _, _, length = struct.unpack_from("iIII", buffer, offset)
+            offset += 16
+
+            if buffer[offset : offset + length].rstrip(b"\0") == name:
+                self.changed()
+
+            offset += length
+
+    async def poll(self) -> None:
+        seen = self.signature
+
+        while True:
+            await asyncio.sleep(self.interval)
+
+            if (signature := self.stat()) != seen:
+                seen = signature
+                self.changed()
+
+    def changed(self) -> None:
+        if self.pending:
+            self.pending.cancel()
+
+        self.pending = asyncio.get_running_loop().call_later(self.debounce, self.settle)
+
+    def settle(self) -> None:
+        self.pending = None
+
+        if (signature := self.stat()) != self.signature:
+            self.signature = signature
+            asyncio.get_running_loop().create_task(self.callback())
 
 
 class Validator:
@@ -141,6 +697,157 @@ class Validator:
             raise TypeError("Not a string")
 
 
+class TargetIndex:
+    # Target names normalized (NFKC, casefolded, whitespace collapsed) into frozen
+    # sets for constant time matching however long the lists get. The trigram table
+    # for spotting near misses is built separately by build(), off the loop.
+
+    ids = ("target.roll.character", "target.roll.series", "target.claim.series")
+    near_threshold = 0.6
+    near_extra = 2
+
+    def __init__(
+        self,
+        characters: Iterable[str] = (),
+        series: Iterable[str] = (),
+        claim_series: Iterable[str] = (),
+    ) -> None:
+        self.characters = frozenset(map(self.normalize, characters))
+        self.roll_series = frozenset(map(self.normalize, series))
+        self.claim_series = frozenset(map(self.normalize, claim_series))
+        self.grams: Optional[Dict[str, List[str]]] = None
+        self.gram_counts: Dict[str, int] = {}
+
+    @staticmethod
+    def normalize(name: str) -> str:
+        return " ".join(unicodedata.normalize("NFKC", name).casefold().split())
+
+    @staticmethod
+    def trigrams(name: str) -> Set[str]:
+        padded = f"  {name} "
+        return {padded[index : index + 3] for index in range(len(padded) - 2)}
+
+    def character(self, name: str) -> bool:
+        return self.normalize(name) in self.characters
+
+    def series(self, name: str) -> bool:
+        return self.normalize(name) in self.roll_series
+
+    def claim(self, name: str) -> bool:
+        return self.normalize(name) in self.claim_series
+
+    def build(self) -> None:
+        grams: Dict[str, List[str]] = {}
+        gram_counts: Dict[str, int] = {}
+
+        for character in self.characters:
+            gram_counts[character] = len(character_grams := self.trigrams(character))
+
+            for gram in character_grams:
+                grams.setdefault(gram, []).append(character)
+
+        # NOTE: Assigned last, as near() takes the table being set as it being built.
+        self.gram_counts, self.grams = gram_counts, grams
+
+    def near(self, name: str) -> Optional[str]:
+        # Closest targeted character by trigram Jaccard similarity, if any is close
+        # enough, or None until build() is done. Exact matches should be checked with
+        # character() beforehand.
+        #
+        # Anything close enough shares at least ceil(threshold * n) of the n trigrams
+        # of the name, so misses at most `slack` of them, and must hit all but
+        # `slack` of any that are looked up. Only the rarest few are, which skips the
+        # long lists of common grams, and the few candidates left are checked exactly.
+        if (table := self.grams) is None:
+            return None
+
+        grams = self.trigrams(self.normalize(name))
+        slack = len(grams) - ceil(self.near_threshold * len(grams))
+        probed = sorted(grams, key=lambda gram: len(table.get(gram, ())))[
+            : slack + self.near_extra
+        ]
+        hits = Counter(chain.from_iterable(table.get(gram, ()) for gram in probed))
+
+        best, best_score = None, self.near_threshold
+
+        for character, count in hits.items():
+            if count < len(probed) - slack:
+                continue
+
+            shared = len(grams & self.trigrams(character))
+            score = shared / (len(grams) + self.gram_counts[character] - shared)
+
+            if score >= best_score:
+                best, best_score = character, score
+
+        return best
+
+
+class TokenBucket:
+    # Budget of sends per window, refilled whole when the window resets rather than
+    # continuously, as Mudae's roll limit works. Counters cover the current window.
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.tokens = capacity
+        self.sent = 0
+        self.throttled = 0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.sent} sent, {self.tokens}/{self.capacity} left, "
+            f"{self.throttled} throttled this window"
+        )
+
+    def take(self) -> bool:
+        if self.tokens <= 0:
+            return False
+
+        self.tokens -= 1
+        self.sent += 1
+        return True
+
+    def refund(self) -> None:
+        # For a send that was rate limited rather than made
+        self.tokens = min(self.tokens + 1, self.capacity)
+        self.sent -= 1
+        self.throttled += 1
+
+    def drain(self) -> None:
+        self.tokens = 0
+
+    def refill(self, capacity: Optional[int] = None) -> None:
+        if capacity is not None:
+            self.capacity = capacity
+
+        self.tokens = self.capacity
+        self.sent = 0
+        self.throttled = 0
+
+
+class Ref(NamedTuple):
+    id: str
+
+
+def compile_schema(
+    schema: Iterable[Tuple[str, Callable, Dict[str, Any]]],
+) -> Tuple[Dict[str, Tuple[Callable, Dict[str, str]]], Dict[str, List[str]]]:
+    # Binds the static arguments of every rule once, leaving only Ref arguments to
+    # be resolved per load, and maps each referenced id to the ids depending on it.
+    rules: Dict[str, Tuple[Callable, Dict[str, str]]] = {}
+    dependents: Dict[str, List[str]] = {}
+
+    for id, validator, kwargs in schema:
+        refs = {key: ref.id for key, ref in kwargs.items() if isinstance(ref, Ref)}
+        static = {key: arg for key, arg in kwargs.items() if key not in refs}
+        rules[id] = (functools.partial(validator, **static), refs)
+
+        for ref_id in refs.values():
+            dependents.setdefault(ref_id, []).append(id)
+
+    return rules, dependents
+
+
 class Config:
     String = items.String
     Integer = items.Integer
@@ -151,45 +858,58 @@ class Config:
     real_types = Union[str, int, float, bool]
     toml_types = Union[items.String, items.Integer, items.Float, items.Bool]
 
-    ids = (
-        "user.token",
-        "user.notify",
-        "user.sound",
-        "user.log",
-        "user.log_max",
-        "user.log_level",
-        "commands.enable",
-        "commands.status",
-        "commands.statusPublic",
-        "commands.config",
-        "commands.dispatch",
-        "commands.notify",
-        "commands.emoji",
-        "commands.emojiSuccess",
-        "commands.emojiFailure",
-        "commands.emojiInvalid",
-        "commands.warn",
-        "commands.warnMessage",
-        "dispatch.roll.auto",
-        "dispatch.roll.command",
-        "dispatch.roll.delay",
-        "dispatch.roll.wpm",
-        "dispatch.claim.auto",
-        "target.roll.kakera",
-        "target.roll.delay",
-        "target.roll.emoji",
-        "target.roll.character",
-        "target.roll.series",
-        "target.claim.series",
-        "server.id",
-        "server.channel",
-        "server.settings.claim",
-        "server.settings.claimReset",
-        "server.settings.claimExpire",
-        "server.settings.claimAnchor",
-        "server.settings.rolls",
+    # id, validator and keyword arguments to the validator. A Ref argument is
+    # resolved to the value of another id, which is revalidated along with it.
+    schema: Tuple[Tuple[str, Callable, Dict[str, Any]], ...] = (
+        ("user.token", Validator.str, {}),
+        ("user.notify", Validator.bool, {}),
+        ("user.sound", Validator.bool, {}),
+        ("user.log", Validator.bool, {}),
+        ("user.log_json", Validator.bool, {}),
+        ("user.log_max", Validator.int, {"range": (1, 100_000)}),
+        ("user.log_level", Validator.int, {"range": (0, 5)}),
+        ("commands.enable", Validator.bool, {}),
+        ("commands.status", Validator.bool, {}),
+        ("commands.statusPublic", Validator.bool, {}),
+        ("commands.config", Validator.bool, {}),
+        ("commands.dispatch", Validator.bool, {}),
+        ("commands.notify", Validator.bool, {}),
+        ("commands.logs", Validator.bool, {}),
+        ("commands.emoji", Validator.bool, {}),
+        ("commands.emojiSuccess", Validator.str, {}),
+        ("commands.emojiFailure", Validator.str, {}),
+        ("commands.emojiInvalid", Validator.str, {}),
+        ("commands.warn", Validator.bool, {}),
+        (
+            "commands.warnMessage",
+            Validator.str_array,
+            {"required": Ref("commands.warn")},
+        ),
+        ("dispatch.roll.auto", Validator.bool, {}),
+        ("dispatch.roll.command", Validator.str, {}),
+        ("dispatch.roll.delay", Validator.float_array, {"length": 2}),
+        ("dispatch.roll.wpm", Validator.int_array, {"length": 2, "required": True}),
+        ("dispatch.claim.auto", Validator.bool, {}),
+        ("target.roll.kakera", Validator.int, {}),
+        ("target.roll.delay", Validator.float_array, {"length": 2}),
+        ("target.roll.emoji", Validator.str, {}),
+        ("target.roll.character", Validator.str_array, {"required": True}),
+        ("target.roll.series", Validator.str_array, {"required": False}),
+        ("target.claim.series", Validator.str_array, {"required": False}),
+        ("server.id", Validator.int, {}),
+        ("server.channel", Validator.int_array, {}),
+        ("server.settings.claim", Validator.int, {"range": (1, 10_080)}),
+        ("server.settings.claimReset", Validator.int, {"range": (0, 59)}),
+        ("server.settings.claimExpire", Validator.int, {}),
+        ("server.settings.claimAnchor", Validator.int, {"range": (0, 23)}),
+        ("server.settings.rolls", Validator.int, {}),
     )
 
+    ids = tuple(id for id, _, _ in schema)
+    rules, dependents = compile_schema(schema)
+
+    write_delay = 1.0
+
     type_map = {
         str: String,
         int: Integer,
@@ -200,98 +920,211 @@ class Config:
 
     def __init__(self) -> None:
         self.path = Path(__file__).parent.joinpath("config.toml").absolute()
+        self.toml: Any = None
+        self.values: Dict[str, Any] = {}
+        self.targets: Optional[TargetIndex] = None
+        self.indexer: Optional[asyncio.Task] = None
+        self.writer: Optional[asyncio.Task] = None
+        self.write_lock = asyncio.Lock()
 
-    async def init(self) -> None:
-        self.file = await open(self.path, "r+")
-        self.file_mtime = int(self.path.stat().st_mtime)
-        self.toml = loads(await self.file.read())
+        # Set by whoever watches the file for changes, so as to not see our own
+        self.watcher: Optional[Watcher] = None
 
-    async def get(self, id: str) -> toml_types:
-        if id in self.ids:
-            joiner = "']['"
-            return eval(f"self.toml['{joiner.join(id.split('.'))}']")
-        else:
-            raise KeyError("Is a non-existent key")
+    @staticmethod
+    def item(toml: Any, id: str) -> Any:
+        for key in id.split("."):
+            toml = toml[key]
 
-    async def set(self, id: str, value: real_types):
-        if id in self.ids:
-            joiner = "']['"
-            exec(f"self.toml[{']['.join(id.split('.'))}] = value")
-        else:
-            raise KeyError("Is a non-existent key")
+        return toml
+
+    @staticmethod
+    def plain(item: Any) -> Any:
+        # NOTE: bool is checked first, being a subclass of int.
+        if isinstance(item, bool):
+            return item
+
+        elif isinstance(item, list):
+            return [Config.plain(sub) for sub in item]
+
+        for real_type in (str, int, float):
+            if isinstance(item, real_type):
+                return real_type(item)
+
+        return item
+
+    @classmethod
+    def compile(cls, toml: Any) -> Dict[str, Any]:
+        values = {}
+
+        for id in cls.ids:
+            try:
+                values[id] = cls.plain(cls.item(toml, id))
+
+            except KeyError:
+                values[id] = None
+
+        return values
+
+    @staticmethod
+    def same(old: Any, new: Any) -> bool:
+        # Unlike ==, tells 1, 1.0 and True apart, as the validators do
+        if type(old) is not type(new) or old != new:
+            return False
+
+        elif isinstance(new, list):
+            return list(map(type, old)) == list(map(type, new))
+
+        return True
+
+    def get(self, id: str) -> Any:
+        # Served from the flat, plain-valued cache compiled by load()
+        try:
+            return self.values[id]
+
+        except KeyError:
+            raise KeyError("Is a non-existent key") from None
+
+    def set(self, id: str, value: real_types) -> None:
+        self.apply({id: value})
+
+    @contextmanager
+    def transaction(self) -> Iterator[Dict[str, real_types]]:
+        # Keys staged in the yielded dict are validated and applied together on exit,
+        # or not at all if any is invalid or the block raises.
+        staged: Dict[str, Config.real_types] = {}
+        yield staged
+        self.apply(staged)
+
+    def apply(self, staged: Dict[str, real_types]) -> None:
+        if unknown := [id for id in staged if id not in self.ids]:
+            raise KeyError(f"Non-existent key(s) {', '.join(unknown)}")
+
+        # NOTE: Booleans are left as is, as that is how tomlkit hands them back.
+        staged_items = {
+            id: value if isinstance(value, bool) else toml_item(value)
+            for id, value in staged.items()
+        }
+        values = {**self.values}
+        values.update((id, self.plain(value)) for id, value in staged.items())
+
+        def lookup(id: str) -> Any:
+            if id in staged_items:
+                return staged_items[id]
+
+            return self.item(self.toml, id)
+
+        self.validate(set(staged), lookup, values)
+
+        for id, item in staged_items.items():
+            *parents, key = id.split(".")
+            self.item(self.toml, ".".join(parents))[key] = item
+
+        self.values = values
+        self.reindex(set(staged))
+
+        if self.writer is None or self.writer.done():
+            self.writer = asyncio.get_running_loop().create_task(self.write_behind())
+
+    def reindex(self, changed: Set[str]) -> None:
+        if self.targets is None or not changed.isdisjoint(TargetIndex.ids):
+            self.targets = TargetIndex(
+                *(self.values[id] for id in TargetIndex.ids)  # type: ignore
+            )
+
+            # Built off the loop, near misses going unnoticed for the moment that
+            # takes, or in place when there is no loop to keep responsive
+            try:
+                self.indexer = asyncio.get_running_loop().create_task(
+                    executors["io"].run(self.targets.build)
+                )
+
+            except RuntimeError:
+                self.targets.build()
+
+    def validate(
+        self, ids: Set[str], lookup: Callable[[str], Any], values: Dict[str, Any]
+    ) -> None:
+        # Any key whose rule refers to one of the given keys is validated as well
+        ids = ids.union(
+            dependent for id in ids for dependent in self.dependents.get(id, ())
+        )
+        errors = []
+
+        for id in self.ids:
+            if id not in ids:
+                continue
+
+            validator, refs = self.rules[id]
+
+            try:
+                item = lookup(id)
+
+            except KeyError:
+                errors.append(f"{id} <- Is missing")
+                continue
+
+            try:
+                kwargs = {key: values[ref] for key, ref in refs.items()}
+                validator(item, **kwargs)
+
+            except Exception as err:
+                errors.append(f"{id} <- {err.__class__.__name__}: {err}")
+
+        if errors:
+            raise ValueError(f"{len(errors)} invalid key(s)\n" + "\n".join(errors))
 
     async def load(self):
         # NOTE: If you see a clusterfuck of Pyright error messages, relax.
         #       https://github.com/sdispater/tomlkit/issues/111
 
-        await self.file.seek(0)
-        self.toml = loads(await self.file.read())
+        # NOTE: Opened afresh every time, as editors that save by renaming a new file
+        #       over the old one would leave a long-lived handle on the old inode.
 
-        async def verify(id: str, validator: Callable, **kwargs):
-            try:
-                validator(await self.get(id), **kwargs)
+        # With set()s not yet written, the file is older than what is in memory and
+        # about to be overwritten with it, so reading it back would undo them.
+        if self.toml is not None and (
+            (self.writer is not None and not self.writer.done())
+            or self.write_lock.locked()
+        ):
+            return
 
-            except Exception as err:
-                raise err.__class__(id + f" <- {err}")
-
-        await verify("user.token", Validator.str)
-        await verify("user.notify", Validator.bool)
-        await verify("user.sound", Validator.bool)
-        await verify("user.log", Validator.bool)
-        await verify("user.log_max", Validator.int)
-        await verify("user.log_level", Validator.int, range=(0, 5))
-
-        await verify("commands.enable", Validator.bool)
-        await verify("commands.status", Validator.bool)
-        await verify("commands.statusPublic", Validator.bool)
-        await verify("commands.config", Validator.bool)
-        await verify("commands.dispatch", Validator.bool)
-        await verify("commands.notify", Validator.bool)
-        await verify("commands.emoji", Validator.bool)
-        await verify("commands.emojiSuccess", Validator.str)
-        await verify("commands.emojiFailure", Validator.str)
-        await verify("commands.emojiInvalid", Validator.str)
-        await verify("commands.emoji", Validator.bool)
-        await verify("commands.warn", Validator.bool)
-        await verify(
-            "commands.warnMessage",
-            Validator.str_array,
-            required=True if await self.get("commands.warn") else False,
-        )
+        async with open(self.path, "r") as file:
+            toml = loads(await file.read())
 
-        await verify("dispatch.roll.auto", Validator.bool)
-        await verify("dispatch.roll.command", Validator.str)
-        await verify("dispatch.roll.delay", Validator.float_array)
-        await verify("dispatch.roll.wpm", Validator.int_array, length=2, required=True)
+        values = self.compile(toml)
 
-        await verify("dispatch.claim.auto", Validator.bool)
+        # Only keys whose value changed since the last load are validated, and every
+        # key on the first, as a missing one compiles to the None it is compared to
+        if self.toml is None:
+            changed = set(self.ids)
+        else:
+            changed = {
+                id for id in self.ids if not self.same(self.values.get(id), values[id])
+            }
 
-        await verify("target.roll.kakera", Validator.int)
-        await verify("target.roll.delay", Validator.float_array, length=2)
-        await verify("target.roll.emoji", Validator.str)
-        await verify("target.roll.character", Validator.str_array, required=True)
-        await verify("target.roll.series", Validator.str_array, required=False)
+        self.validate(changed, lambda id: self.item(toml, id), values)
 
-        await verify("target.claim.series", Validator.str_array, required=False)
+        # Only swapped in once the whole document is valid, and all at once
+        self.toml, self.values = toml, values
+        self.reindex(changed)
 
-        await verify("server.id", Validator.int)
-        await verify("server.channel", Validator.int_array)
+    async def write_behind(self) -> None:
+        # Coalesces every set() within the delay into a single dump
+        await asyncio.sleep(self.write_delay)
+        self.writer = None
+        await self.dump()
 
-        await verify("server.settings.claim", Validator.int)
-        await verify("server.settings.claimReset", Validator.int)
-        await verify("server.settings.claimExpire", Validator.int)
-        await verify("server.settings.claimAnchor", Validator.int)
-        await verify("server.settings.rolls", Validator.int)
+    async def flush(self) -> None:
+        if self.writer is not None and not self.writer.done():
+            self.writer.cancel()
+            self.writer = None
+            await self.dump()
 
     async def dump(self):
-        await self.file.seek(0)
-        await self.file.write(dumps(self.toml))
-        await self.file.truncate()
+        text = dumps(self.toml)
 
-    @rie
-    def last_modified(self) -> int:
-        if self.path.exists():
-            return int(self.path.stat().st_mtime)
+        async with self.write_lock:
+            await write_atomic(self.path, text)
 
-        else:
-            return 0
+            if self.watcher is not None:
+                self.watcher.signature = self.watcher.stat()
@@ -0,0 +1,78 @@
+from datetime import timedelta
+import unittest
+
+from klaimera import Event, EventManager, EventType, Missed
+
+
+async def call() -> None:
+    pass
+
+
+def event(timestamp: float, missed: Missed, recur: bool = True) -> Event:
+    return Event(
+        type=EventType.RESET_ROLL,
+        timestamp=timestamp,
+        call=call,
+        recur=recur,
+        delta=timedelta(seconds=60),
+        missed=missed,
+    )
+
+
+class RescheduleTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.eventmgr = EventManager()
+
+    def test_once(self) -> None:
+        self.assertEqual(
+            self.eventmgr.reschedule(event(100, Missed.SKIP, False), 500), (True, None)
+        )
+
+    def test_on_time(self) -> None:
+        # Within a period of the deadline every policy fires and moves one slot on
+        for missed in Missed:
+            fire, next_event = self.eventmgr.reschedule(event(100, missed), 159)
+
+            self.assertTrue(fire)
+            self.assertEqual(next_event.timestamp, 160)  # type: ignore
+
+    def test_coalesce(self) -> None:
+        fire, next_event = self.eventmgr.reschedule(event(100, Missed.COALESCE), 250)
+
+        self.assertTrue(fire)
+        self.assertEqual(next_event.timestamp, 280)  # type: ignore
+
+    def test_catchup(self) -> None:
+        fire, next_event = self.eventmgr.reschedule(event(100, Missed.CATCHUP), 250)
+
+        self.assertTrue(fire)
+        self.assertEqual(next_event.timestamp, 160)  # type: ignore
+
+    def test_skip(self) -> None:
+        fire, next_event = self.eventmgr.reschedule(event(100, Missed.SKIP), 250)
+
+        self.assertFalse(fire)
+        self.assertEqual(next_event.timestamp, 280)  # type: ignore
+
+    def test_slots_do_not_drift(self) -> None:
+        # The next slot is whole periods from the deadline, not from when it fired
+        fire, next_event = self.eventmgr.reschedule(event(100, Missed.SKIP), 219.5)
+
+        self.assertEqual(next_event.timestamp, 220)  # type: ignore
+
+
+class DispatchTest(unittest.IsolatedAsyncioTestCase):
+    async def test_recurring_needs_period(self) -> None:
+        eventmgr = EventManager()
+
+        for delta in (timedelta(), timedelta(seconds=-1)):
+            with self.assertRaises(ValueError):
+                await eventmgr.dispatch(
+                    EventType.ROLL, call, at=timedelta(), recur=True, delta=delta
+                )
+
+        self.assertEqual(len(eventmgr), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+from datetime import datetime, timezone
+import os
+import time
+import unittest
+
+from kcalendar import HOUR, ResetCalendar
+
+
+def utc(*args: int) -> float:
+    return datetime(*args, tzinfo=timezone.utc).timestamp()
+
+
+class ResetCalendarTest(unittest.TestCase):
+    def setUp(self) -> None:
+        # A zone with DST, so anything taken from local time would show
+        self.tz = os.environ.get("TZ")
+        os.environ["TZ"] = "America/New_York"
+        time.tzset()
+
+    def tearDown(self) -> None:
+        if self.tz is None:
+            del os.environ["TZ"]
+        else:
+            os.environ["TZ"] = self.tz
+
+        time.tzset()
+
+    def test_rolls_at_reset_minute(self) -> None:
+        calendar = ResetCalendar(180, 15, 1)
+
+        self.assertEqual(
+            calendar.rolls(utc(2021, 1, 10, 3, 20), 2),
+            [utc(2021, 1, 10, 4, 15), utc(2021, 1, 10, 5, 15)],
+        )
+
+    def test_claims_from_anchor(self) -> None:
+        calendar = ResetCalendar(180, 15, 1)
+
+        self.assertTrue(calendar.derivable)
+        self.assertEqual(
+            calendar.claims(utc(2021, 1, 10, 0, 0), 3),
+            [utc(2021, 1, 10, 1, 15), utc(2021, 1, 10, 4, 15), utc(2021, 1, 10, 7, 15)],
+        )
+
+    def test_claims_strictly_after(self) -> None:
+        calendar = ResetCalendar(180, 15, 1)
+
+        self.assertEqual(
+            calendar.claims(utc(2021, 1, 10, 1, 15)), [utc(2021, 1, 10, 4, 15)]
+        )
+
+    def test_anchor_wraps_period(self) -> None:
+        # An anchor past the first period lands on the same lattice
+        self.assertEqual(
+            ResetCalendar(180, 15, 22).claim_phase,
+            ResetCalendar(180, 15, 1).claim_phase,
+        )
+
+    def test_not_derivable(self) -> None:
+        calendar = ResetCalendar(150, 15, 1)
+
+        self.assertFalse(calendar.derivable)
+        self.assertEqual(calendar.claims(utc(2021, 1, 10)), [])
+
+    def test_same_hour_across_seasons(self) -> None:
+        # At the anchor in UTC both in standard time and daylight saving, rather than
+        # an hour apart as the local anchor would be.
+        calendar = ResetCalendar(180, 15, 1)
+
+        self.assertEqual(calendar.claims(utc(2021, 1, 10)), [utc(2021, 1, 10, 1, 15)])
+        self.assertEqual(calendar.claims(utc(2021, 7, 10)), [utc(2021, 7, 10, 1, 15)])
+
+    def test_spacing_across_dst_change(self) -> None:
+        # New York moves to daylight saving at 07:00 UTC on 2021-03-14
+        calendar = ResetCalendar(180, 15, 1)
+        claims = calendar.claims(utc(2021, 3, 13, 12, 0), 16)
+        rolls = calendar.rolls(utc(2021, 3, 14, 4, 0), 6)
+
+        self.assertTrue(all(b - a == 3 * HOUR for a, b in zip(claims, claims[1:])))
+        self.assertTrue(all(b - a == HOUR for a, b in zip(rolls, rolls[1:])))
+        self.assertIn(utc(2021, 3, 14, 7, 15), claims)
+
+    def test_observe_snaps_to_roll_reset(self) -> None:
+        # Claims on the hour, but not dividing half a day
+        calendar = ResetCalendar(300, 15, 1)
+
+        self.assertFalse(calendar.derivable)
+        calendar.observe(utc(2021, 1, 10, 3, 2, 40))
+
+        self.assertEqual(
+            calendar.claims(utc(2021, 1, 10, 4, 0)), [utc(2021, 1, 10, 8, 15)]
+        )
+
+    def test_observe_snaps_to_minute(self) -> None:
+        calendar = ResetCalendar(150, 15, 1)
+
+        self.assertFalse(calendar.derivable)
+        calendar.observe(utc(2021, 1, 10, 2, 44, 40))
+
+        self.assertEqual(
+            calendar.claims(utc(2021, 1, 10, 3, 0)), [utc(2021, 1, 10, 5, 15)]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
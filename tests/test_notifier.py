@@ -0,0 +1,91 @@
+from time import monotonic
+import asyncio
+import unittest
+
+from kutils import LocalTransport, Notifier
+
+
+class FailingTransport:
+    def __init__(self) -> None:
+        self.attempts = 0
+
+    def __call__(self, message: str) -> None:
+        self.attempts += 1
+        raise ConnectionError("Unreachable")
+
+
+class NotifierTest(unittest.IsolatedAsyncioTestCase):
+    def notifier(self, transport) -> Notifier:
+        notifier = Notifier(transport)
+        notifier.window = 0.05
+        notifier.backoff = 0.05
+        return notifier
+
+    async def settle(self, notifier: Notifier, timeout: float = 2.0) -> None:
+        deadline = monotonic() + timeout
+
+        while not (notifier.sent or notifier.failed) and monotonic() < deadline:
+            await asyncio.sleep(0.01)
+
+    async def test_coalesces_window(self) -> None:
+        transport = LocalTransport()
+        notifier = self.notifier(transport)
+
+        for message in ("a", "b", "a"):
+            self.assertTrue(notifier.push(message))
+
+        await self.settle(notifier)
+
+        self.assertEqual(transport.sent, ["a\nb"])
+        self.assertEqual((notifier.sent, notifier.coalesced), (1, 2))
+
+    async def test_separate_windows(self) -> None:
+        transport = LocalTransport()
+        notifier = self.notifier(transport)
+
+        notifier.push("a")
+        await self.settle(notifier)
+        notifier.push("b")
+        await asyncio.sleep(notifier.window * 4)
+
+        self.assertEqual(transport.sent, ["a", "b"])
+
+    async def test_disabled(self) -> None:
+        transport = LocalTransport()
+        notifier = self.notifier(transport)
+        notifier.enabled = False
+
+        self.assertTrue(notifier.push("a"))
+        await asyncio.sleep(notifier.window * 2)
+
+        self.assertEqual(transport.sent, [])
+        self.assertIsNone(notifier.worker)
+
+    async def test_drops_when_full(self) -> None:
+        notifier = self.notifier(LocalTransport())
+        notifier.queue_max = 2
+
+        self.assertEqual([notifier.push(str(n)) for n in range(3)], [True, True, False])
+        self.assertEqual(notifier.dropped, 1)
+
+        # Left to send, so the worker is idle on the queue and cancels cleanly
+        await self.settle(notifier)
+
+    async def test_gives_up_without_last_backoff(self) -> None:
+        transport = FailingTransport()
+        notifier = self.notifier(transport)
+        notifier.retries = 3
+
+        stime = monotonic()
+        notifier.push("a")
+        await self.settle(notifier)
+        elapsed = monotonic() - stime
+
+        self.assertEqual((transport.attempts, notifier.failed), (3, 1))
+
+        # Window, then backing off after the first two attempts but not the last
+        self.assertLess(elapsed, notifier.window + notifier.backoff * (1 + 2 + 4))
+
+
+if __name__ == "__main__":
+    unittest.main()